@@ -0,0 +1,145 @@
+import time
+import threading
+import numpy as np
+
+MIN_PERIOD = 100 # fastest callback period in ms, used while readings move quickly
+MAX_PERIOD = 10000 # slowest callback period in ms, used while readings are stable
+INTERVAL = 1.0 # seconds between two controller updates
+DECAY = 0.8 # per update, the estimated rate of change falls slowly and rises immediately
+
+# change per channel that is still considered noise, in the scaled units stored in the sensor buffers
+DEADBANDS = {
+    'air_quality.TEMP': 0.05, 'air_quality.RH': 0.2, 'air_quality.SP': 0.1,
+    'air_quality.IAQIDX': 2, 'air_quality.IAQ_ACC': 1,
+    'humidity.TEMP': 0.05, 'humidity.RH': 0.2,
+    'ir_temperature.OBJ_TEMP': 0.1, 'ir_temperature.AMB_TEMP': 0.1,
+    'co2.CO2_PPM': 10, 'co2.TEMP': 0.05, 'co2.RH': 0.2,
+}
+
+
+class Stream:
+    # one callback configuration of a bricklet. configure(period, value_has_to_change, option, min, max)
+    # applies it, poll() reads the current value through the getter and feeds it to the callback.
+    # Streams with a scale (raw units per buffer unit) also get a threshold band around the last value.
+    def __init__(self, name, sensor_data, deadbands, configure, poll, scale=None):
+        self.name = name
+        self.sensor_data = sensor_data
+        self.deadbands = deadbands # {channel: deadband}, the first channel is used for the threshold band
+        self.configure = configure
+        self.poll = poll
+        self.scale = scale
+        self.period = None
+        self.center = None
+        self.rate = 0.0 # deadbands per second
+        self.cursors = {channel: 0 for channel in deadbands}
+        self.last_values = {}
+        self.last_sample = time.time()
+        self.enabled = False # set once the bricklet has been configured
+        self.reconfigurations = 0
+        self.polls = 0
+        self.errors = 0
+
+
+class AdaptiveController:
+    # sets the callback period of every stream from the recent rate of change of its readings, and lets the
+    # bricklets suppress unchanged values and values inside the deadband. A stream that stayed silent for
+    # heartbeat seconds is polled once, so the aggregation and the stale check still see a current value.
+    def __init__(self, min_period=MIN_PERIOD, max_period=MAX_PERIOD, heartbeat=5.0, interval=INTERVAL):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.heartbeat = heartbeat
+        self.interval = interval
+        self.streams = []
+        self._last_update = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, stream):
+        self.streams.append(stream)
+        return stream
+
+    def targetPeriod(self, rate):
+        # slowest power of two multiple of min_period that still reports about every deadband of change
+        target = 1000.0 / rate if rate > 0 else self.max_period
+        period = self.min_period
+        while period * 2 <= min(target, self.max_period):
+            period *= 2
+        return period
+
+    def apply(self, stream):
+        # (re)configure the bricklet with the current state of the stream, e.g. after setting it up again
+        period = stream.period if stream.period is not None else self.min_period
+        if stream.scale is not None and stream.center is not None:
+            deadband = next(iter(stream.deadbands.values()))
+            low = int(round((stream.center - deadband) * stream.scale))
+            high = int(round((stream.center + deadband) * stream.scale))
+            stream.configure(period, True, 'o', low, high)
+        else:
+            stream.configure(period, True, 'x', 0, 0)
+        stream.period = period
+        stream.enabled = True
+        stream.reconfigurations += 1
+
+    def update(self, now=None):
+        now = time.time() if now is None else now
+        elapsed = now - self._last_update if self._last_update is not None else self.interval
+        self._last_update = now
+        for stream in self.streams:
+            if not stream.enabled:
+                continue
+            try:
+                self.updateStream(stream, now, elapsed)
+            except Exception as e:
+                # a bricklet that does not answer is set up again by the supervisor
+                stream.errors += 1
+                print('[Adaptive sampling] [{}] - Could not update callback configuration: {!r}'.format(stream.name, e))
+
+    def updateStream(self, stream, now, elapsed):
+        rate = 0.0
+        latest = None
+        for channel, deadband in stream.deadbands.items():
+            ts, values, stream.cursors[channel], _ = stream.sensor_data[channel].readSince(stream.cursors[channel])
+            if len(values) == 0:
+                continue
+            if channel in stream.last_values:
+                values = np.append(stream.last_values[channel], values)
+            stream.last_values[channel] = values[-1]
+            rate = max(rate, (values.max() - values.min()) / deadband / max(elapsed, 1e-3))
+            stream.last_sample = max(stream.last_sample, ts[-1])
+            if latest is None:
+                latest = values[-1]
+        stream.rate = float(max(rate, stream.rate * DECAY))
+
+        period = self.targetPeriod(stream.rate)
+        moved = False
+        if stream.scale is not None and latest is not None:
+            # recenter the threshold band once the reading left the middle of it
+            deadband = next(iter(stream.deadbands.values()))
+            moved = stream.center is None or abs(latest - stream.center) > deadband / 2
+            if moved:
+                stream.center = float(latest)
+        if period != stream.period or moved:
+            stream.period = period
+            self.apply(stream)
+
+        if now - stream.last_sample > self.heartbeat:
+            stream.polls += 1
+            stream.last_sample = now
+            stream.poll()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='adaptive-sampling', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def isAlive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.update()
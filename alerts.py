@@ -0,0 +1,269 @@
+import json
+import math
+import queue
+import shlex
+import importlib
+import threading
+import subprocess
+
+from adaptive import DEADBANDS
+
+# Alert rules evaluated in the callback thread on every scaled sample. Each rule keeps a few numbers of
+# state and updates them in constant time, only a change between ok and firing creates an alert. Alerts
+# are handed to a dispatcher thread, so a slow notifier never holds up the callbacks.
+#   {"name": "co2 high", "channel": "co2.CO2_PPM", "type": "threshold", "max": 1500, "groups": ["bedroom"]}
+
+CHANNELS = tuple(DEADBANDS) # 'sensor.CHANNEL' of every channel a rule can watch
+
+
+class Rule:
+    # base of all rules. violated(ts, value) tells whether the sample breaks the rule, the rule fires
+    # after samples violating samples in a row and resolves with the first sample that does not.
+    __slots__ = ('name', 'channel', 'samples', 'active', 'fired', '_count')
+
+    def __init__(self, name, channel, samples=1):
+        self.name = name
+        self.channel = channel
+        self.samples = samples
+        self.active = False
+        self.fired = 0
+        self._count = 0
+
+    def update(self, ts, value):
+        # True when the rule starts firing, False when it resolves, None without a change
+        if self.violated(ts, value):
+            self._count += 1
+            if not self.active and self._count >= self.samples:
+                self.active = True
+                self.fired += 1
+                return True
+        else:
+            self._count = 0
+            if self.active:
+                self.active = False
+                return False
+        return None
+
+    def violated(self, ts, value):
+        raise NotImplementedError
+
+    def describe(self, value):
+        raise NotImplementedError
+
+
+class Threshold(Rule):
+    # value outside [min, max], it has to come back by hysteresis before the rule resolves
+    __slots__ = ('min', 'max', 'hysteresis')
+
+    def __init__(self, name, channel, min=None, max=None, hysteresis=0, samples=1):
+        Rule.__init__(self, name, channel, samples)
+        self.min = -math.inf if min is None else min
+        self.max = math.inf if max is None else max
+        self.hysteresis = hysteresis
+
+    def violated(self, ts, value):
+        margin = self.hysteresis if self.active else 0
+        return value < self.min + margin or value > self.max - margin
+
+    def describe(self, value):
+        if value > self.max:
+            return '{:g} above {:g}'.format(value, self.max)
+        return '{:g} below {:g}'.format(value, self.min)
+
+
+class RateOfChange(Rule):
+    # change per minute, smoothed over about tau seconds so a jump gives the same rate at any callback period
+    __slots__ = ('max', 'tau', 'sign', 'rate', '_last_ts', '_last_value')
+
+    def __init__(self, name, channel, max, tau=30, direction='both', samples=1):
+        Rule.__init__(self, name, channel, samples)
+        self.max = max
+        self.tau = tau
+        self.sign = dict(both=0, rising=1, falling=-1)[direction]
+        self.rate = 0.0
+        self._last_ts = None
+        self._last_value = None
+
+    def violated(self, ts, value):
+        last_ts, last_value = self._last_ts, self._last_value
+        self._last_ts, self._last_value = ts, value
+        if last_ts is None or ts <= last_ts:
+            return self.active
+        dt = ts - last_ts
+        self.rate += (60 * (value - last_value) - self.rate * dt) / (self.tau + dt)
+        return (abs(self.rate) if self.sign == 0 else self.sign * self.rate) > self.max
+
+    def describe(self, value):
+        return 'changing {:+.3g} per minute at {:g}, limit {:g}'.format(self.rate, value, self.max)
+
+
+class Stuck(Rule):
+    # value stayed within tolerance for duration seconds, e.g. a frozen bricklet still sending callbacks
+    __slots__ = ('duration', 'tolerance', '_anchor', '_since')
+
+    def __init__(self, name, channel, duration=600, tolerance=0, samples=1):
+        Rule.__init__(self, name, channel, samples)
+        self.duration = duration
+        self.tolerance = tolerance
+        self._anchor = None
+        self._since = None
+
+    def violated(self, ts, value):
+        if self._anchor is None or abs(value - self._anchor) > self.tolerance:
+            self._anchor, self._since = value, ts
+        return ts - self._since >= self.duration
+
+    def describe(self, value):
+        return 'stuck at {:g} for {:.0f} s'.format(self._anchor, self.duration)
+
+
+class ZScore(Rule):
+    # sample further than z standard deviations from the exponentially weighted mean. alpha is the weight
+    # of each sample, min_std keeps quantized, nearly constant readings from firing on their smallest step.
+    __slots__ = ('z', 'alpha', 'warmup', 'min_std', 'mean', 'variance', '_n', '_diff', '_reference')
+
+    def __init__(self, name, channel, z=4.0, alpha=0.01, warmup=100, min_std=None, samples=1):
+        Rule.__init__(self, name, channel, samples)
+        self.z = z
+        self.alpha = alpha
+        self.warmup = warmup
+        self.min_std = DEADBANDS[channel] if min_std is None else min_std
+        self.mean = 0.0
+        self.variance = 0.0
+        self._n = 0
+        self._diff = 0.0 # distance of the last sample from the mean before it
+        self._reference = 1.0 # variance that distance was compared with
+
+    def violated(self, ts, value):
+        self._n += 1
+        if self._n == 1:
+            self.mean = value
+            return False
+        diff = value - self.mean
+        reference = max(self.variance, self.min_std * self.min_std)
+        self._diff, self._reference = diff, reference
+        # West's incremental update of the weighted mean and variance
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+        return self._n > self.warmup and diff * diff > self.z * self.z * reference
+
+    def describe(self, value):
+        return '{:g} is {:+.1f} standard deviations from the mean {:.4g}'.format(
+            value, self._diff / math.sqrt(self._reference), self.mean - self.alpha * self._diff)
+
+
+RULES = dict(threshold=Threshold, rate=RateOfChange, stuck=Stuck, zscore=ZScore)
+
+
+def makeRule(options):
+    # options from the alert_rules list: type, channel, optional name and groups and the settings of the type
+    options = dict(options)
+    kind = options.pop('type', None)
+    if kind not in RULES:
+        raise ValueError('Unknown alert rule type [{}], use: {}'.format(kind, ', '.join(RULES)))
+    channel = options.pop('channel', None)
+    if channel not in CHANNELS:
+        raise ValueError('Unknown alert channel [{}], use: {}'.format(channel, ', '.join(CHANNELS)))
+    name = options.pop('name', '{} {}'.format(channel, kind))
+    options.pop('groups', None)
+    return RULES[kind](name, channel, **options)
+
+
+class AlertEngine:
+    # the rules of one sensor group by channel, evaluate() is called by the callbacks for every sample
+    def __init__(self, group, rules, dispatcher):
+        self.group = group
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.channel, []).append(rule)
+        self.dispatcher = dispatcher
+
+    def evaluate(self, channel, ts, value):
+        rules = self.rules.get(channel)
+        if rules is None or value != value:
+            return
+        for rule in rules:
+            state = rule.update(ts, value)
+            if state is not None:
+                self.dispatcher.put(dict(group=self.group, rule=rule.name, channel=channel, state='firing' if state else 'resolved',
+                                         time=ts, value=value, message=rule.describe(value) if state else 'back at {:g}'.format(value)))
+
+
+class AlertDispatcher:
+    # delivers alerts to all notifiers from its own thread, in the order they were raised
+    def __init__(self, notifiers):
+        self.notifiers = list(notifiers)
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def put(self, alert):
+        self._queue.put(alert)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='alerts', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        # alerts raised before stop() are still delivered
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def isAlive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            alert = self._queue.get()
+            if alert is None:
+                return
+            for notifier in self.notifiers:
+                try:
+                    notifier.notify(alert)
+                    self.sent += 1
+                except Exception as e:
+                    self.failed += 1
+                    print('[alerts] [{}] - Could not deliver alert [{}]: {!r}'.format(type(notifier).__name__, alert['rule'], e))
+
+
+class LogNotifier:
+    def notify(self, alert):
+        print('[{group}] [alert] [{rule}] {state}: {channel} {message}'.format(**alert))
+
+
+class FileNotifier:
+    # appends one JSON line per alert
+    def __init__(self, path='alerts.jsonl'):
+        self.path = path
+
+    def notify(self, alert):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(alert) + '\n')
+
+
+class CommandNotifier:
+    # runs a local command per alert with the alert as JSON on stdin, e.g. a script sending a push message
+    def __init__(self, command, timeout=10):
+        self.command = shlex.split(command) if isinstance(command, str) else list(command)
+        self.timeout = timeout
+
+    def notify(self, alert):
+        subprocess.run(self.command, input=json.dumps(alert), text=True, timeout=self.timeout, check=True)
+
+
+NOTIFIERS = dict(log=LogNotifier, file=FileNotifier, command=CommandNotifier)
+
+
+def makeNotifier(options):
+    # options from the alert_notifiers list, type is one of NOTIFIERS or "module:Class" of an own notifier
+    options = dict(options)
+    kind = options.pop('type', 'log')
+    if kind in NOTIFIERS:
+        return NOTIFIERS[kind](**options)
+    if ':' in kind:
+        module, attribute = kind.split(':', 1)
+        return getattr(importlib.import_module(module), attribute)(**options)
+    raise ValueError('Unknown alert notifier [{}], use: {} or module:Class'.format(kind, ', '.join(NOTIFIERS)))
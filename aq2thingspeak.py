@@ -1,9 +1,8 @@
 import time
-import numpy as np
+import math
 from datetime import datetime
 
 import statistics as stats
-import thingspeak
 import requests as req
 from tinkerforge.ip_connection import IPConnection
 from tinkerforge.bricklet_air_quality import BrickletAirQuality
@@ -62,13 +61,19 @@ def cb_all_values(iaq_index, iaq_index_accuracy, temperature, humidity, air_pres
 
 
 
+def roundSignificant(value, digits):
+    if value == 0 or not math.isfinite(value):
+        return float(value)
+    return round(float(value), digits - 1 - math.floor(math.log10(abs(value))))
+
+
 def getWindowedMean(window_data):
     mean_data = dict(TSTAMP=max(window_data['TSTAMP']), 
-                        TEMP=float(np.format_float_positional( stats.mean(window_data['TEMP']), precision=3, unique=False, fractional=False, trim='k') ),
-                        RH=float(np.format_float_positional( stats.mean(window_data['RH']), precision=3, unique=False, fractional=False, trim='k') ),
-                        SP=float(np.format_float_positional( stats.mean(window_data['SP']), precision=4, unique=False, fractional=False, trim='k') ),
-                        IAQIDX=float(np.format_float_positional( stats.mean(window_data['IAQIDX']), precision=3, unique=False, fractional=False, trim='k') ),
-                        IAQ_ACC=float(np.format_float_positional( stats.mean(window_data['IAQ_ACC']), precision=2, unique=False, fractional=False, trim='k') )
+                        TEMP=roundSignificant(stats.mean(window_data['TEMP']), 3),
+                        RH=roundSignificant(stats.mean(window_data['RH']), 3),
+                        SP=roundSignificant(stats.mean(window_data['SP']), 4),
+                        IAQIDX=roundSignificant(stats.mean(window_data['IAQIDX']), 3),
+                        IAQ_ACC=roundSignificant(stats.mean(window_data['IAQ_ACC']), 2)
                     )
     return mean_data
 
@@ -100,16 +105,14 @@ if __name__ == "__main__":
     # Don't use device before ipcon is connected
 
     START_TIME = datetime.now()
-    while True:
-        # Register all values callback to function cb_all_values
-        aq.register_callback(aq.CALLBACK_ALL_VALUES, cb_all_values)
 
-        # Set period for all values callback to 1s (1000ms)
-        aq.set_all_values_callback_configuration(CALL_BACK_PERIOD, False)
+    # Register all values callback to function cb_all_values
+    aq.register_callback(aq.CALLBACK_ALL_VALUES, cb_all_values)
 
-        #print('Averaging measurements for 15 sec . . . .')
-        
+    # Set period for all values callback to 1s (1000ms)
+    aq.set_all_values_callback_configuration(CALL_BACK_PERIOD, False)
 
+    # callbacks run in the IP connection thread, the main thread only waits here without using CPU
     input("Press key to exit\n") # Use raw_input() in Python 2
     ipcon.disconnect()
     
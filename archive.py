@@ -0,0 +1,233 @@
+import os
+import sys
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+SEGMENT_TIME = 3600 # seconds of raw samples per segment file
+FLUSH_TIME = 60 # seconds of raw samples kept in memory before they are written as a part of the segment
+FLUSH_SAMPLES = 1 << 16 # samples per channel kept in memory before they are written, whatever their time span
+INDEX_DTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('count', '<u4')])
+
+# Local archive of raw samples. Every channel of a group has its own directory of compressed
+# columnar segments (timestamps as millisecond deltas, values as float32) and a small index of
+# their time ranges, so a query only opens the segments overlapping the requested range.
+# Samples are written as parts of the current segment every flush_time seconds, each part is a
+# segment file of its own in the index until the segment is complete and its parts are merged.
+#   <root>/<group>/<sensor>.<channel>/index.npy
+#   <root>/<group>/<sensor>.<channel>/<segment start in ms>.npz
+
+
+class ChannelWriter:
+    # collects the samples of one channel in memory until a part is due, at most flush_time
+    # seconds or flush_samples samples, and merges the parts once the segment is complete
+    def __init__(self, path, segment_time, flush_time=FLUSH_TIME, flush_samples=FLUSH_SAMPLES):
+        self.path = path
+        self.segment_time = segment_time
+        self.flush_time = flush_time
+        self.flush_samples = flush_samples
+        self._ts = []
+        self._values = []
+        self._count = 0
+        self._start = None # first sample of the samples in memory
+        self._segment = None # first sample of the current segment
+        self._parts = [] # start in ms of the parts written for the current segment
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, ts, values):
+        if len(ts) == 0:
+            return
+        if self._segment is None:
+            self._segment = ts[0]
+        if self._start is None:
+            self._start = ts[0]
+        self._ts.append(ts)
+        self._values.append(values)
+        self._count += len(ts)
+        if ts[-1] - self._segment >= self.segment_time:
+            self.flush()
+        elif ts[-1] - self._start >= self.flush_time or self._count >= self.flush_samples:
+            self._writePart()
+
+    def flush(self):
+        # writes the samples in memory and closes the segment
+        self._writePart()
+        if len(self._parts) > 1:
+            self._merge()
+        self._parts, self._segment = [], None
+
+    def _writePart(self):
+        if not self._ts:
+            return
+        ts = np.concatenate(self._ts)
+        values = np.concatenate(self._values).astype(np.float32)
+        self._ts, self._values, self._count, self._start = [], [], 0, None
+
+        start_ms = int(ts[0] * 1000)
+        ts_ms = np.round(ts * 1000).astype(np.int64)
+        writeSegment(self.path, start_ms, ts_ms, values)
+        index = readIndex(self.path)
+        entry = np.array([(start_ms / 1000.0, ts_ms[-1] / 1000.0, len(ts))], dtype=INDEX_DTYPE)
+        writeIndex(self.path, np.concatenate((index, entry)) if len(index) else entry)
+        self._parts.append(start_ms)
+
+    def _merge(self):
+        # one file per segment under the name of its first part. Until the index is rewritten, the entry
+        # of the first part only covers its own samples of the merged file, see Archive.iterRange
+        ts_ms, values = [], []
+        for start_ms in self._parts:
+            with np.load(os.path.join(self.path, '{}.npz'.format(start_ms))) as part:
+                ts_ms.append(np.cumsum(part['dt'], dtype=np.int64) + start_ms)
+                values.append(part['values'])
+        ts_ms, values = np.concatenate(ts_ms), np.concatenate(values)
+        writeSegment(self.path, self._parts[0], ts_ms, values)
+
+        index = readIndex(self.path)
+        parts = len(self._parts)
+        entry = np.array([(index['start'][-parts], index['end'][-1], len(values))], dtype=INDEX_DTYPE)
+        writeIndex(self.path, np.concatenate((index[:-parts], entry)))
+        for start_ms in self._parts[1:]:
+            os.remove(os.path.join(self.path, '{}.npz'.format(start_ms)))
+
+
+def writeSegment(path, start_ms, ts_ms, values):
+    name = '{}.npz'.format(start_ms)
+    tmp = os.path.join(path, name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, dt=np.diff(ts_ms - start_ms, prepend=0).astype(np.int32), values=values)
+    os.replace(tmp, os.path.join(path, name))
+
+
+def readIndex(path, mmap=False):
+    index_file = os.path.join(path, 'index.npy')
+    if not os.path.exists(index_file):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.load(index_file, mmap_mode='r' if mmap else None)
+
+
+def writeIndex(path, index):
+    tmp = os.path.join(path, 'index.tmp.npy')
+    np.save(tmp, index)
+    os.replace(tmp, os.path.join(path, 'index.npy'))
+
+
+class ArchiveWriter:
+    # raw samples of one sensor group, fed with the window snapshots of its sensor buffers
+    def __init__(self, root, group, segment_time=SEGMENT_TIME, flush_time=FLUSH_TIME):
+        self.path = os.path.join(root, group)
+        self.segment_time = segment_time
+        self.flush_time = flush_time
+        self._channels = {}
+
+    def append(self, sensor, window):
+        # window as returned by SensorBuffer.snapshot(): {channel: (timestamps, values)}
+        for channel, (ts, values) in window.items():
+            key = '{}.{}'.format(sensor, channel)
+            writer = self._channels.get(key)
+            if writer is None:
+                writer = self._channels[key] = ChannelWriter(os.path.join(self.path, key), self.segment_time, self.flush_time)
+            writer.append(ts, values)
+
+    def flush(self):
+        for writer in self._channels.values():
+            writer.flush()
+
+
+class Archive:
+    # read access to the archive, segments are only loaded while the query iterates over them
+    def __init__(self, root):
+        self.root = root
+
+    def groups(self):
+        return sorted(os.listdir(self.root))
+
+    def channels(self, group):
+        return sorted(os.listdir(os.path.join(self.root, group)))
+
+    def iterRange(self, group, channel, start, end):
+        # yields (timestamps, values) of every segment overlapping [start, end)
+        path = os.path.join(self.root, group, channel)
+        index = readIndex(path, mmap=True)
+        if len(index) == 0:
+            return
+        overlapping = np.nonzero((index['start'] < end) & (index['end'] >= start))[0]
+        for i in overlapping:
+            start_ms = int(round(index['start'][i] * 1000))
+            with np.load(os.path.join(path, '{}.npz'.format(start_ms))) as segment:
+                ts = (np.cumsum(segment['dt'], dtype=np.int64) + start_ms) / 1000.0
+                values = segment['values']
+            # a segment file can hold more samples than its entry while its parts are merged,
+            # half a millisecond covers the rounding of the stored timestamps
+            lo, hi = np.searchsorted(ts, (start, min(end, index['end'][i] + 0.0005)))
+            if hi > lo:
+                yield ts[lo:hi], values[lo:hi]
+
+    def query(self, group, channel, start, end, step=None):
+        # raw samples in [start, end), or per step seconds the bucket start, mean, min, max and count
+        if step is None:
+            chunks = list(self.iterRange(group, channel, start, end))
+            if not chunks:
+                return np.zeros(0), np.zeros(0, dtype=np.float32)
+            return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+        # an open range ends at the stored samples, buckets are counted from start
+        index = readIndex(os.path.join(self.root, group, channel))
+        if len(index):
+            start = max(start, float(index['start'][0]))
+            end = min(end, float(index['end'][-1]) + step)
+        if len(index) == 0 or end <= start:
+            return dict(ts=np.zeros(0), mean=np.zeros(0), min=np.zeros(0), max=np.zeros(0), count=np.zeros(0, dtype=np.int64))
+        buckets = int(np.ceil((end - start) / step))
+        total = np.zeros(buckets)
+        count = np.zeros(buckets, dtype=np.int64)
+        vmin = np.full(buckets, np.inf)
+        vmax = np.full(buckets, -np.inf)
+        for ts, values in self.iterRange(group, channel, start, end):
+            idx = ((ts - start) // step).astype(np.int64)
+            np.add.at(total, idx, values)
+            np.add.at(count, idx, 1)
+            np.minimum.at(vmin, idx, values)
+            np.maximum.at(vmax, idx, values)
+
+        filled = count > 0
+        bucket_start = start + step * np.arange(buckets)
+        return dict(ts=bucket_start[filled], mean=total[filled] / count[filled],
+                    min=vmin[filled], max=vmax[filled], count=count[filled])
+
+
+def parseTime(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query raw samples from the local archive.')
+    parser.add_argument('root', help='archive directory')
+    parser.add_argument('group', nargs='?', help='sensor group, lists groups when missing')
+    parser.add_argument('channel', nargs='?', help='e.g. co2.CO2_PPM, lists channels when missing')
+    parser.add_argument('--start', type=parseTime, default=0, help='ISO date or unix time')
+    parser.add_argument('--end', type=parseTime, default=float('inf'), help='ISO date or unix time')
+    parser.add_argument('--step', type=float, default=60, help='seconds per output row, 0 for raw samples')
+    args = parser.parse_args()
+
+    archive = Archive(args.root)
+    if args.group is None:
+        print('\n'.join(archive.groups()))
+        sys.exit()
+    if args.channel is None:
+        print('\n'.join(archive.channels(args.group)))
+        sys.exit()
+
+    if args.step:
+        result = archive.query(args.group, args.channel, args.start, args.end, args.step)
+        print('time,mean,min,max,count')
+        for row in zip(result['ts'], result['mean'], result['min'], result['max'], result['count']):
+            print('{},{:.4g},{:.4g},{:.4g},{}'.format(datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S'), *row[1:]))
+    else:
+        ts, values = archive.query(args.group, args.channel, args.start, args.end)
+        print('time,value')
+        for t, v in zip(ts, values):
+            print('{:.3f},{:.4g}'.format(t, v))
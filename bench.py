@@ -0,0 +1,195 @@
+import os
+import io
+import shutil
+import tempfile
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import simulator
+from sources import loadSource
+from collector import Collector, makeConfig, CALLBACK_TIME
+from alerts import CHANNELS
+from scheduler import WindowScheduler
+
+# End-to-end benchmark of the collector against simulated bricklets and a local ThingSpeak stand-in.
+# For each callback period it reports ingest throughput, aggregation cost per window,
+# window end to upload latency, CPU use and memory.
+
+PERIODS = (500, 100, 20, 5, 1) # callback periods in milliseconds
+DURATION = 10 # seconds per callback period
+WINDOW = 1 # seconds per aggregation window, shorter than SAMPLE_TIME to collect enough windows
+GROUPS = 1 # simulated rooms, each on its own brickd connection
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # accepts bulk updates like ThingSpeak and records when each window arrived
+    arrivals = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        now = time.time()
+        for update in body['updates']:
+            StandInHandler.arrivals.append((update['created_at'], now))
+        self.send_response(202)
+        self.end_headers()
+        self.wfile.write(b'{"success":true}')
+
+    def log_message(self, *args):
+        pass
+
+
+def rssBytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def benchRules(count):
+    # count rules per group spread over all channels and rule types, with limits the simulated readings rarely cross
+    kinds = (dict(type='threshold', min=-1e6, max=1e6), dict(type='rate', max=1e6), dict(type='stuck', duration=3600),
+             dict(type='zscore', z=50))
+    return [dict(kinds[i % len(kinds)], name='bench{}'.format(i), channel=CHANNELS[i % len(CHANNELS)]) for i in range(count)]
+
+
+def benchConfig(period, window, groups, url, spool_dir, adaptive=False, sinks=('thingspeak',), record_dir=None, alert_rules=0):
+    return makeConfig(dict(
+        source='simulator',
+        callback_period=period,
+        sample_time=window,
+        rollup_resolutions=(window * 3,),
+        spool_dir=spool_dir,
+        archive_dir=os.path.join(spool_dir, 'archive'),
+        archive_segment=window * 5,
+        archive_flush=window * 2,
+        metrics_port=None,
+        record_dir=record_dir,
+        alert_rules=benchRules(alert_rules),
+        alert_notifiers=[dict(type='file', path=os.path.join(spool_dir, 'alerts.jsonl'))],
+        adaptive=adaptive,
+        adaptive_min_period=period,
+        connections=[dict(name='sim{}'.format(i), host='localhost', groups=[dict(
+            name='room{}'.format(i), channel_id=i, write_key='bench', url=url, sinks=[dict(type=sink) for sink in sinks],
+            bricklets=dict(air_quality='AIQ', humidity='HUM', ir_temperature='IRT', co2='CO2'))]) for i in range(groups)]))
+
+
+def runPeriod(period, duration, window, groups, url, adaptive=False, sinks=('thingspeak',), power_cycle=None, record_dir=None,
+              alert_rules=0):
+    StandInHandler.arrivals = []
+    spool_dir = tempfile.mkdtemp()
+    collector = Collector(benchConfig(period, window, groups, url, spool_dir, adaptive, sinks, record_dir, alert_rules),
+                          loadSource('simulator'))
+    for connection in collector.connections:
+        connection.connect()
+        for group in connection.groups:
+            for bricklet in group.uids:
+                group.setup(bricklet)(collector.source, connection.ipcon)
+    for group in collector.groups:
+        for sink in group.sinks:
+            sink.min_interval = 0
+            sink.start()
+        if group.controller is not None:
+            group.controller.start()
+    if collector.alerts is not None:
+        collector.alerts.start()
+
+    callbacks = [(child.sum, child.count) for child in CALLBACK_TIME.children.values()]
+    recovery = [(c.recovery_time.sum, c.recovery_time.count) for c in collector.connections]
+    aggregation = []
+    scheduler = WindowScheduler(window)
+    cpu0, wall0 = time.process_time(), time.monotonic()
+    while time.monotonic() - wall0 < duration:
+        if power_cycle is not None and time.monotonic() - wall0 >= duration / 2:
+            # the simulated stacks lose power once, their callbacks have to be restored by enumeration
+            for connection in collector.connections:
+                connection.ipcon.powerCycle(power_cycle)
+            power_cycle = None
+        window_end, _, _ = scheduler.wait()
+        t0 = time.perf_counter()
+        collector.processWindow(window_end)
+        aggregation.append(time.perf_counter() - t0)
+    cpu, wall = time.process_time() - cpu0, time.monotonic() - wall0
+    callback_sum = sum(child.sum for child in CALLBACK_TIME.children.values()) - sum(s for s, _ in callbacks)
+    callback_count = sum(child.count for child in CALLBACK_TIME.children.values()) - sum(n for _, n in callbacks)
+
+    for group in collector.groups:
+        if group.controller is not None:
+            group.controller.stop()
+    for connection in collector.connections:
+        connection.disconnect()
+    if collector.recorder is not None:
+        collector.recorder.close()
+    if collector.alerts is not None:
+        collector.alerts.stop()
+    time.sleep(0.2) # let the sinks write the last window
+    for group in collector.groups:
+        for sink in group.sinks:
+            sink.stop()
+            sink.queue.close()
+    shutil.rmtree(spool_dir)
+
+    # channels of one bricklet can come from separate callbacks, e.g. humidity and IR temperature
+    buffers = [sensor_data for group in collector.groups for sensor_data in group.buffers.values()]
+    samples = sum(sensor_data[ch].written for sensor_data in buffers for ch in sensor_data)
+    dropped = sum(sensor_data.dropped for sensor_data in buffers) + sum(c.ipcon.dropped for c in collector.connections)
+    restored = [(c.recovery_time.sum - s, c.recovery_time.count - n) for c, (s, n) in zip(collector.connections, recovery)]
+    latencies = []
+    for created_at, arrived in StandInHandler.arrivals:
+        latencies.append(arrived - datetime.fromisoformat(created_at).timestamp())
+
+    return dict(period=period,
+                samples_per_s=samples / wall,
+                dropped=dropped,
+                callback_us=1e6 * callback_sum / max(1, callback_count),
+                aggregation_ms=1000 * sum(aggregation) / max(1, len(aggregation)),
+                aggregation_max_ms=1000 * max(aggregation, default=0),
+                latency_ms=1000 * sum(latencies) / max(1, len(latencies)),
+                latency_max_ms=1000 * max(latencies, default=0),
+                cpu=100 * cpu / wall,
+                rss_mb=rssBytes() / 2**20,
+                recovery_s=sum(s for s, _ in restored) / max(1, sum(n for _, n in restored)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collector throughput benchmark with simulated bricklets.')
+    parser.add_argument('--periods', type=int, nargs='+', default=PERIODS, help='callback periods in ms')
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds per callback period')
+    parser.add_argument('--window', type=int, default=WINDOW, help='aggregation window in seconds')
+    parser.add_argument('--groups', type=int, default=GROUPS, help='simulated rooms, one connection each')
+    parser.add_argument('--noise', type=float, default=simulator.NOISE_LEVEL, help='scale of the simulated noise')
+    parser.add_argument('--adaptive', action='store_true', help='change driven callbacks, periods are the fastest period')
+    parser.add_argument('--sinks', nargs='+', default=['thingspeak'], help='outputs of every group, e.g. thingspeak csv sqlite')
+    parser.add_argument('--power-cycle', type=float, help='seconds without power for all simulated stacks, halfway through each run')
+    parser.add_argument('--record', metavar='DIR', help='keep a callback log of each period in DIR/<period>ms for replay.py')
+    parser.add_argument('--alert-rules', type=int, default=0, metavar='N', help='alert rules evaluated per group')
+    parser.add_argument('--dropout', type=float, default=simulator.DROPOUT_RATE, help='probability of a lost callback')
+    args = parser.parse_args()
+
+    simulator.NOISE_LEVEL = args.noise
+    simulator.DROPOUT_RATE = args.dropout
+    simulator.SEED = 0
+
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    print('{:>8} {:>12} {:>8} {:>8} {:>10} {:>10} {:>11} {:>11} {:>6} {:>8} {:>10}'.format(
+            'period', 'samples/s', 'dropped', 'cb us', 'agg ms', 'agg max', 'upload ms', 'upload max', 'cpu %', 'rss MB', 'recovery s'))
+    for period in args.periods:
+        # the collector prints every posted window, keep the table readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = runPeriod(period, args.duration, args.window, args.groups, url, args.adaptive, args.sinks, args.power_cycle,
+                               os.path.join(args.record, '{}ms'.format(period)) if args.record else None, args.alert_rules)
+        print('{period:>6}ms {samples_per_s:>12.0f} {dropped:>8} {callback_us:>8.1f} {aggregation_ms:>10.3f} {aggregation_max_ms:>10.3f} '
+              '{latency_ms:>11.1f} {latency_max_ms:>11.1f} {cpu:>6.1f} {rss_mb:>8.1f} {recovery_s:>10.2f}'.format(**result))
+        sys.stdout.flush()
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
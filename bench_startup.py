@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Cold start benchmark. Every run starts a fresh interpreter, like tfy.py after a crash, and reports
+# the time until the collector module is imported and until the first sample arrives from the
+# simulated bricklets. With --imports the slowest modules of one import are listed.
+
+RUNS = 5
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+FIRST_SAMPLE_TIMEOUT = 10 # seconds
+
+
+def child(spawned):
+    # runs in the new interpreter, spawned is the wall clock time of the parent before starting it
+    started = time.time()
+    import collector
+    imported = time.time()
+
+    spool_dir = tempfile.mkdtemp()
+    config = collector.makeConfig(dict(
+        source='simulator', spool_dir=spool_dir, archive_dir=None, metrics_port=None,
+        connections=[dict(host='localhost', groups=[dict(name='startup', sinks=[dict(type='csv')])])]))
+    c = collector.Collector(config)
+    for connection in c.connections:
+        connection.connect()
+        for group in connection.groups:
+            for bricklet in group.uids:
+                group.setup(bricklet)(c.source, connection.ipcon)
+
+    first = None
+    while first is None and time.time() - imported < FIRST_SAMPLE_TIMEOUT:
+        if any(data[channel].written for group in c.groups for data in group.buffers.values() for channel in data):
+            first = time.time()
+        else:
+            time.sleep(0.001)
+    for connection in c.connections:
+        connection.disconnect()
+
+    print(json.dumps(dict(interpreter=started - spawned, imports=imported - started,
+                          first_sample=(first - spawned) if first else None,
+                          modules=len(sys.modules))))
+
+
+def importTimes(module, top):
+    # cumulative import time per module from python -X importtime
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=SCRIPT_DIR, capture_output=True, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.rstrip()))
+    # nested modules are indented by two more spaces, only top level entries add up to the total
+    total = sum(us for us, name in times if not name.startswith('  '))
+    print('import {}: {:.0f} ms in total'.format(module, total / 1000))
+    for us, name in sorted(times, reverse=True)[:top]:
+        print('{:>10.1f} ms  {}'.format(us / 1000, name.strip()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start time of the collector with simulated bricklets.')
+    parser.add_argument('--runs', type=int, default=RUNS, help='fresh interpreters to start')
+    parser.add_argument('--imports', type=int, metavar='N', help='list the N slowest imports of aq2thingspeak_v2')
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+        return
+    if args.imports:
+        importTimes('aq2thingspeak_v2', args.imports)
+        return
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, os.path.realpath(__file__), '--child', repr(time.time())],
+                                cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print('{:>6} {:>16} {:>12} {:>18} {:>8}'.format('run', 'interpreter ms', 'imports ms', 'first sample ms', 'modules'))
+    for i, r in enumerate(results):
+        print('{:>6} {:>16.1f} {:>12.1f} {:>18} {:>8}'.format(i + 1, 1000 * r['interpreter'], 1000 * r['imports'],
+              '{:.1f}'.format(1000 * r['first_sample']) if r['first_sample'] is not None else 'timeout', r['modules']))
+    median = lambda key: sorted(r[key] for r in results)[len(results) // 2] if all(r[key] is not None for r in results) else float('nan')
+    print('{:>6} {:>16.1f} {:>12.1f} {:>18.1f}'.format('median', 1000 * median('interpreter'), 1000 * median('imports'),
+                                                       1000 * median('first_sample')))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,830 @@
+import os
+import json
+import math
+import time
+import threading
+import traceback
+import numpy as np
+
+from sources import loadSource, BRICKLET_CLASSES
+from ringbuffer import SensorBuffer
+from rollup import RollupEngine, roundSignificant
+from fusion import Fusion, FUSED, MIN_SPREAD, MAX_POINTS
+from adaptive import AdaptiveController, Stream, DEADBANDS
+from sinks import FanOut, WindowQueue, MqttSink, CsvSink, SqliteSink, UPLOAD_FIELDS, ROLLUP_FIELDS, POLICIES, QUEUE_SIZE
+from spool import Spool, MAX_RECORDS
+from archive import ArchiveWriter
+from recorder import CallbackRecorder
+from alerts import AlertEngine, AlertDispatcher, makeRule, makeNotifier
+from scheduler import WindowScheduler
+from supervisor import Supervisor, Component
+from metrics import REGISTRY, MetricsServer
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# defaults for every value missing in the config file
+DEFAULT_CONFIG = dict(
+    source='tinkerforge', # or 'simulator' to run without brickd and bricklets
+    callback_period=500, # sensor callback function time in milliseconds
+    sample_time=20, # number of seconds for collecting measurements for one timestamp
+    rollup_resolutions=(60, 900, 3600), # longer window lengths in seconds aggregated next to sample_time
+    buffer_capacity=4096, # least samples kept per channel, grown to BUFFER_HEADROOM windows of callbacks
+    stale_time=10, # seconds without any sample after which a bricklet is set up again
+    spool_dir=SCRIPT_DIR, # one spool file of unsent windows per group and spilling sink
+    archive_dir=os.path.join(SCRIPT_DIR, 'archive'), # raw samples of every channel, None to disable
+    archive_segment=3600, # seconds of raw samples per archive segment
+    archive_flush=60, # seconds of raw samples kept in memory before they are written as a part of the segment
+    record_dir=None, # log of every raw callback for replay.py, None to disable
+    record_segment=3600, # seconds of callbacks per log file
+    metrics_port=9108, # local Prometheus endpoint on 127.0.0.1, None to disable
+    stats_interval=60, # seconds between two compact stats lines, 0 to disable
+    adaptive=False, # change driven callbacks, the period follows how fast the readings move instead of callback_period
+    adaptive_min_period=100, # fastest callback period in milliseconds with adaptive sampling
+    adaptive_max_period=10000, # slowest callback period in milliseconds with adaptive sampling
+    heartbeat=5, # seconds after which a silent bricklet is polled once with adaptive sampling, below stale_time
+    deadbands={}, # e.g. {"co2.CO2_PPM": 20}, changes that are treated as noise, defaults in adaptive.DEADBANDS
+    alert_rules=[], # checked on every sample, for all groups or the ones in the groups list of a rule, see alerts.py
+    alert_notifiers=[dict(type='log')], # where alerts go: log, file, command or module:Class
+    connections=[],
+)
+DEFAULT_PORT = 4223
+ENUMERATE_TIMEOUT = 2 # seconds connect() waits for bricklets configured without uid
+BUFFER_HEADROOM = 2 # windows of callbacks the ring buffers hold, room for a late or missed window
+BRICKLETS = ('air_quality', 'humidity', 'ir_temperature', 'co2')
+SINK_TYPES = ('thingspeak', 'mqtt', 'csv', 'sqlite')
+DEFAULT_SINKS = [dict(type='thingspeak')] # used by groups without a sinks list
+# bricklet type -> (callback constant of the bricklet class, SensorGroup method) of every registered callback
+CALLBACKS = dict(air_quality=(('CALLBACK_ALL_VALUES', 'cb_all_values_AQ'),),
+                 humidity=(('CALLBACK_HUMIDITY', 'cb_humidity_rhumidity'), ('CALLBACK_TEMPERATURE', 'cb_humidity_temperature')),
+                 ir_temperature=(('CALLBACK_OBJECT_TEMPERATURE', 'cb_object_temperature'), ('CALLBACK_AMBIENT_TEMPERATURE', 'cb_ambient_temperature')),
+                 co2=(('CALLBACK_ALL_VALUES', 'cb_all_values_co2'),))
+
+CALLBACK_TIME = REGISTRY.histogram('collector_callback_seconds', 'Execution time of bricklet callbacks', ('group', 'sensor'))
+WINDOW_TIME = REGISTRY.histogram('collector_window_seconds', 'Aggregation time per window and group', ('group',))
+ERRORS = REGISTRY.counter('collector_errors_total', 'Failures in callbacks and window processing', ('group', 'sensor'))
+RECOVERY_TIME = REGISTRY.histogram('collector_bricklet_recovery_seconds', 'Time from losing a bricklet until its callbacks are restored',
+                                   ('connection',))
+
+
+def loadConfig(path):
+    # JSON file listing brickd connections, each with its groups of bricklets, see collector.example.json
+    with open(path) as f:
+        config = json.load(f)
+    return makeConfig(config)
+
+
+def makeConfig(config):
+    merged = dict(DEFAULT_CONFIG)
+    merged.update(config)
+    names = set()
+    for connection in merged['connections']:
+        connection.setdefault('port', DEFAULT_PORT)
+        connection.setdefault('name', '{}:{}'.format(connection['host'], connection['port']))
+        for group in connection['groups']:
+            if group['name'] in names:
+                raise ValueError('Group name [{}] is used more than once'.format(group['name']))
+            names.add(group['name'])
+            # bricklets without uid, "auto" or a group without bricklets are found through enumeration
+            bricklets = group.setdefault('bricklets', {bricklet: None for bricklet in BRICKLETS})
+            for bricklet, uid in bricklets.items():
+                if uid == 'auto':
+                    bricklets[bricklet] = None
+            unknown = set(group['bricklets']) - set(BRICKLETS)
+            if unknown:
+                raise ValueError('Unknown bricklets {} in group [{}], use: {}'.format(sorted(unknown), group['name'], ', '.join(BRICKLETS)))
+            sinks = group.setdefault('sinks', DEFAULT_SINKS)
+            for sink in sinks:
+                if sink.get('type') not in SINK_TYPES:
+                    raise ValueError('Unknown sink type [{}] in group [{}], use: {}'.format(sink.get('type'), group['name'], ', '.join(SINK_TYPES)))
+                if sink.get('policy', 'spill') not in POLICIES:
+                    raise ValueError('Unknown sink policy [{}] in group [{}], use: {}'.format(sink['policy'], group['name'], ', '.join(POLICIES)))
+            sink_names = [sink.get('name', sink['type']) for sink in sinks]
+            if len(set(sink_names)) != len(sink_names):
+                raise ValueError('Sink names in group [{}] are not unique: {}'.format(group['name'], sink_names))
+    if merged['adaptive'] and merged['heartbeat'] >= merged['stale_time']:
+        raise ValueError('heartbeat [{}] must be shorter than stale_time [{}]'.format(merged['heartbeat'], merged['stale_time']))
+    unknown = set(merged['deadbands']) - set(DEADBANDS)
+    if unknown:
+        raise ValueError('Unknown deadbands {}, use: {}'.format(sorted(unknown), ', '.join(DEADBANDS)))
+    rule_names = [makeRule(rule).name for rule in merged['alert_rules']]
+    if len(set(rule_names)) != len(rule_names):
+        raise ValueError('Alert rule names are not unique: {}'.format(rule_names))
+    for rule in merged['alert_rules']:
+        unknown = set(rule.get('groups', ())) - names
+        if unknown:
+            raise ValueError('Unknown groups {} in alert rule [{}]'.format(sorted(unknown), rule.get('name', rule['channel'])))
+    return merged
+
+
+def bufferCapacity(config):
+    # samples per channel for BUFFER_HEADROOM windows at the fastest callback period, at least buffer_capacity
+    period = min(config['callback_period'], config['adaptive_min_period']) if config['adaptive'] else config['callback_period']
+    return max(config['buffer_capacity'], int(math.ceil(BUFFER_HEADROOM * config['sample_time'] * 1000 / max(period, 1))))
+
+
+def makeSink(config, group, options):
+    # options from the sinks list of a group: type, name, policy, queue_size, batching and the settings of the type
+    options = dict(options)
+    kind = options.pop('type')
+    name = options.pop('name', kind)
+    policy = options.pop('policy', 'spill' if kind == 'thingspeak' else 'drop_oldest')
+    if policy == 'spill':
+        # windows left in the spool by a previous run are written first
+        file_name = '{}.spool'.format(group['name']) if name == 'thingspeak' else '{}.{}.spool'.format(group['name'], name)
+        queue = Spool(os.path.join(config['spool_dir'], file_name), fields=len(UPLOAD_FIELDS),
+                      max_records=options.pop('queue_size', MAX_RECORDS))
+    else:
+        queue = WindowQueue(options.pop('queue_size', QUEUE_SIZE), drop=policy[len('drop_'):])
+
+    if kind == 'thingspeak':
+        # requests is only imported when a group posts to ThingSpeak
+        from uploader import ThingSpeakUploader, THINGSPEAK_URL
+        return ThingSpeakUploader(options.pop('channel_id', group.get('channel_id', '')), options.pop('write_key', group.get('write_key', '')),
+                                  queue=queue, base_url=options.pop('url', group.get('url', THINGSPEAK_URL)),
+                                  name=name, group=group['name'], **options)
+    if kind == 'csv':
+        options.setdefault('path', os.path.join(config['spool_dir'], 'csv'))
+    if kind == 'sqlite':
+        options.setdefault('path', os.path.join(config['spool_dir'], 'aq2thingspeak.sqlite'))
+    return dict(mqtt=MqttSink, csv=CsvSink, sqlite=SqliteSink)[kind](name, queue=queue, group=group['name'], **options)
+
+
+def getWindowedMean(window_stats):
+    # window_stats maps each channel to its rollup Accumulator for the window, samples are weighted by
+    # how long they were valid, so fast callbacks while a value moves do not outweigh a stable phase
+    mean_data = {}
+    for key in window_stats:
+        mean_data[key] = roundSignificant(window_stats[key].timeMean)
+
+    return mean_data
+
+
+def aggregateWindow(aq_mean, hm_mean, it_mean, co2_mean, fused):
+    # combine per sensor window means and the fused values into the uploaded fields, NaN without data
+    nan = float('nan')
+    return dict( CO2_PPM=co2_mean.get('CO2_PPM', nan),
+                 AVG_TEMP=roundSignificant(fused['AVG_TEMP']),
+                 AVG_RH=roundSignificant(fused['AVG_RH']),
+                 SP=aq_mean.get('SP', nan),
+                 OBJ_TEMP=it_mean.get('OBJ_TEMP', nan),
+                 AMB_TEMP=it_mean.get('AMB_TEMP', nan),
+                 IAQIDX=aq_mean.get('IAQIDX', nan),
+                 IAQ_ACC=aq_mean.get('IAQ_ACC', nan))
+
+
+def rollupRows(stats, fused):
+    # (channel, count, mean, min, max, std) of every channel of a closed rollup window, stats maps each sensor
+    # to its accumulators. The fused fields only have a mean. Channels that only carried a held value have no count.
+    nan = float('nan')
+    rows = []
+    for sensor, window_stats in stats.items():
+        for channel, acc in window_stats.items():
+            if acc.count == 0 and acc.weight == 0:
+                continue
+            rows.append(('{}.{}'.format(sensor, channel), acc.count, roundSignificant(acc.timeMean),
+                         acc.min if acc.count else nan, acc.max if acc.count else nan, roundSignificant(acc.std) if acc.count else nan))
+    for field, value in fused.items():
+        rows.append((field, 0, roundSignificant(value), nan, nan, nan))
+    return rows
+
+
+class SensorGroup:
+    # one stack of bricklets (one room) with its own sample buffers, rollups and ThingSpeak channel
+    def __init__(self, config, group, source, recorder=None, alerts=None):
+        self.name = group['name']
+        self.uids = dict(group['bricklets']) # None until a bricklet of that type is discovered
+        self.recorder = recorder
+        self.sample_time = config['sample_time']
+        self.callback_period = config['callback_period']
+        capacity = bufferCapacity(config)
+        resolutions = (self.sample_time,) + tuple(r for r in config['rollup_resolutions'] if r != self.sample_time)
+
+        # for each sensor, store timestamped samples in preallocated ring buffers per channel
+        self.aq_data = SensorBuffer(('TEMP', 'RH', 'SP', 'IAQIDX', 'IAQ_ACC'), capacity)
+        self.hum_data = SensorBuffer(('TEMP', 'RH'), capacity)
+        self.irt_data = SensorBuffer(('OBJ_TEMP', 'AMB_TEMP'), capacity)
+        self.co2_data = SensorBuffer(('CO2_PPM', 'TEMP', 'RH'), capacity)
+        self.buffers = dict(air_quality=self.aq_data, humidity=self.hum_data, ir_temperature=self.irt_data, co2=self.co2_data)
+        self.callback_time = {sensor: CALLBACK_TIME.labels(self.name, sensor) for sensor in BRICKLETS}
+        self.errors = {sensor: ERRORS.labels(self.name, sensor) for sensor in BRICKLETS + ('window', 'record')}
+        self.window_time = WINDOW_TIME.labels(self.name)
+        self.fault = None # Supervisor.fault while the collector runs, told about bricklets failing in their callbacks
+
+        # streaming statistics per sensor for every window length
+        hold = 2 * config['heartbeat'] if config['adaptive'] else None
+        self.rollups = [RollupEngine(resolutions, hold) for _ in range(4)]
+
+        # AVG_TEMP and AVG_RH from the time aligned raw samples of all bricklets measuring them
+        period = (config['adaptive_min_period'] if config['adaptive'] else self.callback_period) / 1000.0
+        step = max(period, self.sample_time / MAX_POINTS)
+        self.fusion = {field: Fusion(sources, MIN_SPREAD[field], step, hold or config['stale_time']) for field, sources in FUSED.items()}
+
+        # alert rules of this group, evaluated by the callbacks with every new sample
+        self.alerts = None
+        rules = [makeRule(rule) for rule in config['alert_rules'] if self.name in rule.get('groups', (self.name,))]
+        if alerts is not None and rules:
+            self.alerts = AlertEngine(self.name, rules, alerts)
+
+        # callback functions by (bricklet, callback id), they log their raw arguments while recording
+        self.callbacks = {}
+        for bricklet in self.uids:
+            cls = getattr(source, BRICKLET_CLASSES[bricklet][1])
+            for constant, method in CALLBACKS[bricklet]:
+                callback_id = getattr(cls, constant)
+                self.callbacks[bricklet, callback_id] = self.recorded(bricklet, cls.DEVICE_IDENTIFIER, callback_id, getattr(self, method))
+
+        # bricklet objects of the current connection, used by the adaptive controller
+        self.devices = {}
+        self.controller = None
+        self.streams = {}
+        if config['adaptive']:
+            deadbands = dict(DEADBANDS)
+            deadbands.update(config['deadbands'])
+            self.controller = AdaptiveController(config['adaptive_min_period'], config['adaptive_max_period'], config['heartbeat'])
+            for sensor, streams in self.adaptiveStreams(deadbands).items():
+                self.streams[sensor] = [self.controller.add(stream) for stream in streams]
+
+        # raw samples are kept locally next to the uploaded means
+        self.archive = None
+        if config['archive_dir']:
+            self.archive = ArchiveWriter(config['archive_dir'], self.name, config['archive_segment'], config['archive_flush'])
+
+        # every closed window goes to all sinks of the group, each with its own queue and writer thread
+        self.sinks = [makeSink(config, group, options) for options in group['sinks']]
+        self.output = FanOut(self.sinks)
+        self.rollups_closed = {} # resolution -> rows of the newest closed rollup window, exported as metrics
+
+    # Callback function for all values callback
+    def cb_all_values_AQ(self, iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure, ts=None):
+        t0 = time.perf_counter()
+        try:
+            # collect measurements, ts is only given when a log is replayed
+            ts = time.time() if ts is None else ts
+            self.aq_data['TEMP'].append(temperature/100.0, ts)   # °C
+            self.aq_data['RH'].append(humidity/100.0, ts)    # %RH
+            self.aq_data['SP'].append(air_pressure/100.0, ts)    # hPa
+            self.aq_data['IAQIDX'].append(iaq_index, ts)
+            self.aq_data['IAQ_ACC'].append(iaq_index_accuracy, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('air_quality.TEMP', ts, temperature/100.0)
+                self.alerts.evaluate('air_quality.RH', ts, humidity/100.0)
+                self.alerts.evaluate('air_quality.SP', ts, air_pressure/100.0)
+                self.alerts.evaluate('air_quality.IAQIDX', ts, iaq_index)
+                self.alerts.evaluate('air_quality.IAQ_ACC', ts, iaq_index_accuracy)
+        except:
+            self.errors['air_quality'].inc()
+            print("[{}] [Air Quality Sensor] - Could not retrieve data from sensor!".format(self.name))
+            self.reportFault('air_quality', 'could not retrieve data from sensor')
+        self.callback_time['air_quality'].observe(time.perf_counter() - t0)
+
+    def cb_object_temperature(self, temperature, ts=None):
+        t0 = time.perf_counter()
+        try:
+            ts = time.time() if ts is None else ts
+            self.irt_data['OBJ_TEMP'].append(temperature/10, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('ir_temperature.OBJ_TEMP', ts, temperature/10)
+        except:
+            self.errors['ir_temperature'].inc()
+            print("[{}] [IR Temp Sensor] - Could not retrieve object temperature from sensor!".format(self.name))
+            self.reportFault('ir_temperature', 'could not retrieve object temperature from sensor')
+        self.callback_time['ir_temperature'].observe(time.perf_counter() - t0)
+
+    def cb_ambient_temperature(self, temperature, ts=None):
+        t0 = time.perf_counter()
+        try:
+            ts = time.time() if ts is None else ts
+            self.irt_data['AMB_TEMP'].append(temperature/10, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('ir_temperature.AMB_TEMP', ts, temperature/10)
+        except:
+            self.errors['ir_temperature'].inc()
+            print("[{}] [IR Temp Sensor] - Could not retrieve ambient temperature from sensor!".format(self.name))
+            self.reportFault('ir_temperature', 'could not retrieve ambient temperature from sensor')
+        self.callback_time['ir_temperature'].observe(time.perf_counter() - t0)
+
+    def cb_humidity_rhumidity(self, humidity, ts=None):
+        t0 = time.perf_counter()
+        try:
+            ts = time.time() if ts is None else ts
+            self.hum_data['RH'].append(humidity/100, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('humidity.RH', ts, humidity/100)
+        except:
+            self.errors['humidity'].inc()
+            print("[{}] [Humidity Sensor] - Could not retrieve humidity from sensor!".format(self.name))
+            self.reportFault('humidity', 'could not retrieve humidity from sensor')
+        self.callback_time['humidity'].observe(time.perf_counter() - t0)
+
+    def cb_humidity_temperature(self, temperature, ts=None):
+        t0 = time.perf_counter()
+        try:
+            ts = time.time() if ts is None else ts
+            self.hum_data['TEMP'].append(temperature/100, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('humidity.TEMP', ts, temperature/100)
+        except:
+            self.errors['humidity'].inc()
+            print("[{}] [Humidity Sensor] - Could not retrieve temperature from sensor!".format(self.name))
+            self.reportFault('humidity', 'could not retrieve temperature from sensor')
+        self.callback_time['humidity'].observe(time.perf_counter() - t0)
+
+    def cb_all_values_co2(self, co2_concentration, temperature, humidity, ts=None):
+        t0 = time.perf_counter()
+        try:
+            ts = time.time() if ts is None else ts
+            self.co2_data['CO2_PPM'].append(co2_concentration, ts)
+            self.co2_data['TEMP'].append(temperature/100, ts)
+            self.co2_data['RH'].append(humidity/100, ts)
+            if self.alerts is not None:
+                self.alerts.evaluate('co2.CO2_PPM', ts, co2_concentration)
+                self.alerts.evaluate('co2.TEMP', ts, temperature/100)
+                self.alerts.evaluate('co2.RH', ts, humidity/100)
+        except:
+            self.errors['co2'].inc()
+            print("[{}] [CO2 Sensor] - Could not retrieve data from sensor!".format(self.name))
+            self.reportFault('co2', 'could not retrieve data from sensor')
+        self.callback_time['co2'].observe(time.perf_counter() - t0)
+
+    def recorded(self, bricklet, device_identifier, callback_id, callback):
+        # the function registered with the bindings, which also logs the raw arguments when recording
+        if self.recorder is None:
+            return callback
+        record = self.recorder.record
+
+        def run(*args):
+            try:
+                record(self.uids[bricklet], device_identifier, callback_id, args)
+            except OSError:
+                # a full disk must not cost the live samples
+                self.errors['record'].inc()
+            callback(*args)
+        return run
+
+    def adaptiveStreams(self, deadbands):
+        # one stream per callback configuration, single value callbacks also get a threshold band in raw units.
+        # Heartbeat polls go through the registered callbacks, so they are recorded as well.
+        devices = self.devices
+        callback = lambda sensor, constant: self.callbacks[sensor, getattr(devices[sensor], constant)]
+        channels = lambda sensor, *names: {name: deadbands['{}.{}'.format(sensor, name)] for name in names}
+        return dict(
+            air_quality=[Stream('air_quality', self.aq_data, channels('air_quality', 'IAQIDX', 'TEMP', 'RH', 'SP'),
+                                lambda period, change, *_: devices['air_quality'].set_all_values_callback_configuration(period, change),
+                                lambda: callback('air_quality', 'CALLBACK_ALL_VALUES')(*devices['air_quality'].get_all_values()))],
+            humidity=[Stream('humidity.RH', self.hum_data, channels('humidity', 'RH'),
+                             lambda *c: devices['humidity'].set_humidity_callback_configuration(*c),
+                             lambda: callback('humidity', 'CALLBACK_HUMIDITY')(devices['humidity'].get_humidity()), scale=100),
+                      Stream('humidity.TEMP', self.hum_data, channels('humidity', 'TEMP'),
+                             lambda *c: devices['humidity'].set_temperature_callback_configuration(*c),
+                             lambda: callback('humidity', 'CALLBACK_TEMPERATURE')(devices['humidity'].get_temperature()), scale=100)],
+            ir_temperature=[Stream('ir_temperature.OBJ_TEMP', self.irt_data, channels('ir_temperature', 'OBJ_TEMP'),
+                                   lambda *c: devices['ir_temperature'].set_object_temperature_callback_configuration(*c),
+                                   lambda: callback('ir_temperature', 'CALLBACK_OBJECT_TEMPERATURE')(devices['ir_temperature'].get_object_temperature()), scale=10),
+                            Stream('ir_temperature.AMB_TEMP', self.irt_data, channels('ir_temperature', 'AMB_TEMP'),
+                                   lambda *c: devices['ir_temperature'].set_ambient_temperature_callback_configuration(*c),
+                                   lambda: callback('ir_temperature', 'CALLBACK_AMBIENT_TEMPERATURE')(devices['ir_temperature'].get_ambient_temperature()), scale=10)],
+            co2=[Stream('co2', self.co2_data, channels('co2', 'CO2_PPM', 'TEMP', 'RH'),
+                        lambda period, change, *_: devices['co2'].set_all_values_callback_configuration(period, change),
+                        lambda: callback('co2', 'CALLBACK_ALL_VALUES')(*devices['co2'].get_all_values()))])
+
+    def configureAdaptive(self, sensor):
+        # a new device object starts with the period and threshold band the controller chose last
+        for stream in self.streams[sensor]:
+            self.controller.apply(stream)
+
+    def setupAirQuality(self, source, ipcon):
+        # air quality callback config
+        aq = source.BrickletAirQuality(self.uids['air_quality'], ipcon)
+        aq.register_callback(aq.CALLBACK_ALL_VALUES, self.callbacks['air_quality', aq.CALLBACK_ALL_VALUES])
+        self.devices['air_quality'] = aq
+        if self.controller is not None:
+            self.configureAdaptive('air_quality')
+            return
+        aq.set_all_values_callback_configuration(self.callback_period, False)
+
+    def setupCO2(self, source, ipcon):
+        # co2 callback config
+        co2 = source.BrickletCO2V2(self.uids['co2'], ipcon)
+        co2.register_callback(co2.CALLBACK_ALL_VALUES, self.callbacks['co2', co2.CALLBACK_ALL_VALUES])
+        self.devices['co2'] = co2
+        if self.controller is not None:
+            self.configureAdaptive('co2')
+            return
+        co2.set_all_values_callback_configuration(self.callback_period, False)
+
+    def setupHumidity(self, source, ipcon):
+        # callback for humidity sensor
+        hm = source.BrickletHumidityV2(self.uids['humidity'], ipcon)
+        hm.register_callback(hm.CALLBACK_HUMIDITY, self.callbacks['humidity', hm.CALLBACK_HUMIDITY])
+        hm.register_callback(hm.CALLBACK_TEMPERATURE, self.callbacks['humidity', hm.CALLBACK_TEMPERATURE])
+        self.devices['humidity'] = hm
+        if self.controller is not None:
+            self.configureAdaptive('humidity')
+            return
+
+        # Configuration for humidity sensor callbacks
+        hm.set_humidity_callback_configuration(self.callback_period, False, 'x', 0, 0)
+        hm.set_temperature_callback_configuration(self.callback_period, False, 'x', 0, 0)
+
+    def setupIRTemperature(self, source, ipcon):
+        # Register object temperature callback to function for object and ambient temperatures
+        it = source.BrickletTemperatureIRV2(self.uids['ir_temperature'], ipcon)
+        it.register_callback(it.CALLBACK_OBJECT_TEMPERATURE, self.callbacks['ir_temperature', it.CALLBACK_OBJECT_TEMPERATURE])
+        it.register_callback(it.CALLBACK_AMBIENT_TEMPERATURE, self.callbacks['ir_temperature', it.CALLBACK_AMBIENT_TEMPERATURE])
+        self.devices['ir_temperature'] = it
+        if self.controller is not None:
+            self.configureAdaptive('ir_temperature')
+            return
+
+        it.set_object_temperature_callback_configuration(self.callback_period, False, 'x', 0, 0)
+        it.set_ambient_temperature_callback_configuration(self.callback_period, False, 'x', 0, 0)
+
+    def reportFault(self, bricklet, cause):
+        # the supervisor sets the bricklet up again, callbacks keep running meanwhile
+        if self.fault is not None:
+            self.fault('{} {}'.format(self.name, bricklet), cause)
+
+    def setup(self, bricklet):
+        setup = dict(air_quality=self.setupAirQuality, humidity=self.setupHumidity,
+                     ir_temperature=self.setupIRTemperature, co2=self.setupCO2)[bricklet]
+
+        def run(source, ipcon):
+            if self.uids[bricklet] is None:
+                raise RuntimeError('No {} bricklet found by enumeration yet'.format(bricklet))
+            setup(source, ipcon)
+        return run
+
+    def processWindow(self, window_end):
+        # feed samples of the current window into the rollups and close all finished windows
+        windows = {}
+        for rollup, (sensor, sensor_data) in zip(self.rollups, self.buffers.items()):
+            window = windows[sensor] = sensor_data.snapshot()
+            if self.archive is not None:
+                self.archive.append(sensor, window)
+            rollup.update(window, window_end)
+        closed = [rollup.close(window_end) for rollup in self.rollups]
+        fused = {field: fusion.fuse(windows, window_end - self.sample_time, window_end) for field, fusion in self.fusion.items()}
+
+        for (resolution, aq_stats), (_, hm_stats), (_, it_stats), (_, co2_stats) in zip(*closed):
+            # aggregate for current timestamp
+            means = dict(air_quality=getWindowedMean(aq_stats), humidity=getWindowedMean(hm_stats),
+                         ir_temperature=getWindowedMean(it_stats), co2=getWindowedMean(co2_stats))
+            combined = fused
+            if resolution != self.sample_time:
+                # longer windows combine the per sensor means with the current noise weights
+                combined = {field: fusion.combine([means[sensor].get(channel, np.nan) for sensor, channel in fusion.sources])
+                            for field, fusion in self.fusion.items()}
+            data_for_upload = aggregateWindow(means['air_quality'], means['humidity'], means['ir_temperature'], means['co2'], combined)
+
+            if resolution == self.sample_time:
+                self.writeToCloud(data_for_upload, window_end)
+            else:
+                # longer windows go with their full statistics to the sinks that store rollups
+                stats = dict(air_quality=aq_stats, humidity=hm_stats, ir_temperature=it_stats, co2=co2_stats)
+                rows = rollupRows(stats, combined)
+                self.rollups_closed[resolution] = rows
+                self.output.pushRollup(resolution, window_end, rows)
+
+    def writeToCloud(self, data_to_write, window_end):
+        print('[{}] Posting: [{} : {} : {} : {} : {} : {} : {} : {}]'.format(self.name,
+                                                                    data_to_write['CO2_PPM'],
+                                                                    data_to_write['AVG_TEMP'],
+                                                                    data_to_write['AVG_RH'],
+                                                                    data_to_write['SP'],
+                                                                    data_to_write['OBJ_TEMP'],
+                                                                    data_to_write['AMB_TEMP'],
+                                                                    data_to_write['IAQIDX'],
+                                                                    data_to_write['IAQ_ACC'] ))
+        # only queued here, the sink threads write without blocking the sampling loop
+        self.output.push(window_end, data_to_write)
+
+
+class Connection:
+    # one brickd endpoint and its IP connection, the bindings run a receive and a callback thread per connection.
+    # Bricklets are matched to groups by enumeration and set up again whenever they or brickd come back,
+    # because a reset bricklet has lost its callback configuration.
+    def __init__(self, source, config, groups):
+        self.source = source
+        self.name = config['name']
+        self.host = config['host']
+        self.port = config['port']
+        self.groups = groups
+        self.ipcon = None
+        self.device_types = {getattr(source, attribute).DEVICE_IDENTIFIER: bricklet
+                             for bricklet, (_, attribute) in BRICKLET_CLASSES.items() if getattr(source, attribute) is not None}
+        self.lost = {} # (group, bricklet) -> monotonic time the bricklet was lost
+        self.discovered = threading.Event()
+        self.recovery_time = RECOVERY_TIME.labels(self.name)
+
+    # callback whenever IP connection re-established
+    def cb_connected(self, connect_reason):
+        if connect_reason == self.source.IPConnection.CONNECT_REASON_REQUEST:
+            print("[{}] Connected by request".format(self.name))
+        elif connect_reason == self.source.IPConnection.CONNECT_REASON_AUTO_RECONNECT:
+            print("[{}] Auto-Reconnect".format(self.name))
+            # bricklets reset while brickd was away answer with their uid and are configured again
+            self.ipcon.enumerate()
+
+    def cb_disconnected(self, disconnect_reason):
+        if disconnect_reason == self.source.IPConnection.DISCONNECT_REASON_REQUEST:
+            return
+        print("[{}] Connection to brickd lost, waiting for auto-reconnect".format(self.name))
+        now = time.monotonic()
+        for group in self.groups:
+            for bricklet, uid in group.uids.items():
+                if uid is not None:
+                    self.lost.setdefault((group, bricklet), now)
+
+    def cb_enumerate(self, uid, connected_uid, position, hardware_version, firmware_version, device_identifier, enumeration_type):
+        bricklet = self.device_types.get(device_identifier)
+        if bricklet is None:
+            return
+        group = self.findGroup(uid, bricklet)
+        if group is None:
+            return
+        if enumeration_type == self.source.IPConnection.ENUMERATION_TYPE_DISCONNECTED:
+            print("[{}] [{}] {} bricklet [{}] disconnected".format(self.name, group.name, bricklet, uid))
+            self.lost.setdefault((group, bricklet), time.monotonic())
+            return
+        if (enumeration_type == self.source.IPConnection.ENUMERATION_TYPE_AVAILABLE and (group, bricklet) not in self.lost
+                and bricklet in group.devices and group.devices[bricklet].ipcon is self.ipcon):
+            # answer to our own enumerate() for a bricklet that is already set up
+            return
+
+        t0 = time.monotonic()
+        try:
+            group.setup(bricklet)(self.source, self.ipcon)
+        except Exception as e:
+            print("[{}] [{}] Could not set up {} bricklet [{}]: {!r}".format(self.name, group.name, bricklet, uid, e))
+            group.reportFault(bricklet, 'setup after enumeration failed: {!r}'.format(e))
+            return
+        lost = self.lost.pop((group, bricklet), None)
+        if lost is not None:
+            self.recovery_time.observe(time.monotonic() - lost)
+            print("[{}] [{}] {} bricklet [{}] restored after [{:.2f}] s, setup took [{:.1f}] ms".format(
+                self.name, group.name, bricklet, uid, time.monotonic() - lost, 1000 * (time.monotonic() - t0)))
+        elif enumeration_type == self.source.IPConnection.ENUMERATION_TYPE_CONNECTED:
+            print("[{}] [{}] {} bricklet [{}] was reset, callbacks restored in [{:.1f}] ms".format(
+                self.name, group.name, bricklet, uid, 1000 * (time.monotonic() - t0)))
+
+    def findGroup(self, uid, bricklet):
+        # the group configured with this uid, or else the first group still waiting for this type of bricklet
+        for group in self.groups:
+            if group.uids.get(bricklet) == uid:
+                return group
+        for group in self.groups:
+            if bricklet in group.uids and group.uids[bricklet] is None:
+                group.uids[bricklet] = uid
+                print("[{}] [{}] Found {} bricklet [{}]".format(self.name, group.name, bricklet, uid))
+                if all(uid is not None for g in self.groups for uid in g.uids.values()):
+                    self.discovered.set()
+                return group
+        return None
+
+    def connect(self):
+        # Create IP connection
+        self.ipcon = self.source.IPConnection()
+        self.ipcon.register_callback(self.ipcon.CALLBACK_ENUMERATE, self.cb_enumerate)
+        self.ipcon.register_callback(self.ipcon.CALLBACK_CONNECTED, self.cb_connected)
+        self.ipcon.register_callback(self.ipcon.CALLBACK_DISCONNECTED, self.cb_disconnected)
+
+        # Don't use device before ipcon is connected
+        self.ipcon.connect(self.host, self.port) # Connect to brickd
+
+        # allow auto-reconnect if IP conn disconnects for whatever reason
+        self.ipcon.set_auto_reconnect(True)
+        self.ipcon.enumerate()
+        if not all(uid is not None for group in self.groups for uid in group.uids.values()):
+            # give bricklets configured without uid the chance to answer before they are set up
+            self.discovered.wait(ENUMERATE_TIMEOUT)
+
+    def disconnect(self):
+        if self.ipcon is not None and self.ipcon.get_connection_state() != self.source.IPConnection.CONNECTION_STATE_DISCONNECTED:
+            self.ipcon.disconnect()
+
+    def check(self, component):
+        if self.ipcon.get_connection_state() == self.source.IPConnection.CONNECTION_STATE_DISCONNECTED:
+            return 'disconnected from brickd'
+
+
+def checkSamples(sensor_data, stale_time):
+    # a bricklet has failed when none of its channels received a sample for stale_time seconds
+    def check(component):
+        last = component.started
+        for channel in sensor_data:
+            latest = sensor_data[channel].latest()
+            if latest is not None and latest[0] > last:
+                last = latest[0]
+        if time.time() - last > stale_time:
+            return 'no samples for [{:.0f}] s'.format(time.time() - last)
+    return check
+
+
+def checkSink(sink):
+    def check(component):
+        if not sink.isAlive():
+            return 'sink thread stopped'
+    return check
+
+
+def checkController(controller):
+    def check(component):
+        if not controller.isAlive():
+            return 'adaptive sampling thread stopped'
+    return check
+
+
+def checkAlerts(dispatcher):
+    def check(component):
+        if not dispatcher.isAlive():
+            return 'alert thread stopped'
+    return check
+
+
+class Collector:
+    # all brickd connections and sensor groups of one process, sharing one window schedule and supervisor.
+    # Kept across restarts of run(), so buffers and queued data survive a crash of the main loop.
+    def __init__(self, config, source=None):
+        self.config = config
+        # only the bricklet modules used by some group are imported
+        used = {bricklet for connection in config['connections'] for group in connection['groups'] for bricklet in group['bricklets']}
+        self.source = source if source is not None else loadSource(config['source'], used)
+        self.sample_time = config['sample_time']
+        self.recorder = CallbackRecorder(config['record_dir'], config['record_segment']) if config['record_dir'] else None
+        self.alerts = AlertDispatcher([makeNotifier(n) for n in config['alert_notifiers']]) if config['alert_rules'] else None
+        self.connections = []
+        self.groups = []
+        for connection in config['connections']:
+            groups = [SensorGroup(config, group, self.source, self.recorder, self.alerts) for group in connection['groups']]
+            self.groups.extend(groups)
+            self.connections.append(Connection(self.source, connection, groups))
+
+        self.supervisor = None
+        self.scheduler = None
+        self.restarts = 0 # component restarts of earlier runs plus restarts of run() itself
+        self.runs = 0
+        self._last_stats = None
+        self.registerMetrics()
+        self.metrics_server = MetricsServer(config['metrics_port']) if config['metrics_port'] else None
+
+    def registerMetrics(self):
+        REGISTRY.function('collector_samples_total', 'Samples received per channel', ('group', 'sensor', 'channel'),
+                          lambda: [((g.name, sensor, ch), data[ch].written) for g in self.groups
+                                   for sensor, data in g.buffers.items() for ch in data], kind='counter')
+        REGISTRY.function('collector_samples_dropped_total', 'Samples overwritten in the ring buffers before aggregation',
+                          ('group', 'sensor'), lambda: [((g.name, sensor), data.dropped) for g in self.groups
+                                                        for sensor, data in g.buffers.items()], kind='counter')
+        REGISTRY.function('collector_windows_missed_total', 'Windows skipped because the main loop woke up too late', (),
+                          lambda: [((), self.scheduler.missed if self.scheduler else 0)], kind='counter')
+        REGISTRY.function('collector_windows_late_total', 'Windows processed late but not skipped', (),
+                          lambda: [((), self.scheduler.late if self.scheduler else 0)], kind='counter')
+        sinks = lambda: [(g, sink) for g in self.groups for sink in g.sinks]
+        REGISTRY.function('collector_sink_queue_depth', 'Windows waiting in the queue of each sink', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), len(sink.queue)) for g, sink in sinks()])
+        REGISTRY.function('collector_sink_lag_seconds', 'Age of the oldest window not yet written by each sink', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), sink.lag()) for g, sink in sinks()])
+        REGISTRY.function('collector_sink_written_total', 'Windows written by each sink', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), sink.written) for g, sink in sinks()], kind='counter')
+        REGISTRY.function('collector_sink_rejected_total', 'Windows dropped because the destination refused them', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), sink.rejected) for g, sink in sinks()], kind='counter')
+        REGISTRY.function('collector_sink_dropped_total', 'Windows dropped from the full queue of each sink', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), sink.queue.dropped) for g, sink in sinks()], kind='counter')
+        REGISTRY.function('collector_sink_failures_total', 'Failed batch writes of each sink', ('group', 'sink'),
+                          lambda: [((g.name, sink.name), sink.failed) for g, sink in sinks()], kind='counter')
+        REGISTRY.function('collector_callback_period_ms', 'Callback period chosen by adaptive sampling', ('group', 'stream'),
+                          lambda: [((g.name, s.name), s.period or 0) for g in self.groups if g.controller for s in g.controller.streams])
+        REGISTRY.function('collector_heartbeat_polls_total', 'Values polled from bricklets that stayed silent', ('group', 'stream'),
+                          lambda: [((g.name, s.name), s.polls) for g in self.groups if g.controller for s in g.controller.streams],
+                          kind='counter')
+        REGISTRY.function('collector_fusion_rejected_total', 'Aligned samples rejected as outliers by the fusion', ('group', 'field'),
+                          lambda: [((g.name, field), fusion.rejected) for g in self.groups for field, fusion in g.fusion.items()],
+                          kind='counter')
+        REGISTRY.function('collector_fusion_weight', 'Relative weight of each sensor in the fusion', ('group', 'field', 'sensor'),
+                          lambda: [((g.name, field, sensor), w) for g in self.groups for field, fusion in g.fusion.items()
+                                   for (sensor, _), w in zip(fusion.sources, fusion.weights() / fusion.weights().sum())])
+        rules = lambda: [(g, rule) for g in self.groups if g.alerts for rules in g.alerts.rules.values() for rule in rules]
+        REGISTRY.function('collector_rollup', 'Statistics of the newest closed rollup window', ('group', 'resolution', 'channel', 'stat'),
+                          lambda: [((g.name, str(resolution), row[0], field.lower()), value) for g in self.groups
+                                   for resolution, rows in list(g.rollups_closed.items()) for row in rows
+                                   for field, value in zip(ROLLUP_FIELDS, row[1:]) if value == value])
+        REGISTRY.function('collector_alerts_total', 'Times each alert rule started firing', ('group', 'rule'),
+                          lambda: [((g.name, rule.name), rule.fired) for g, rule in rules()], kind='counter')
+        REGISTRY.function('collector_alert_firing', 'Alert rules currently firing', ('group', 'rule'),
+                          lambda: [((g.name, rule.name), int(rule.active)) for g, rule in rules()])
+        REGISTRY.function('collector_alert_failures_total', 'Alerts a notifier could not deliver', (),
+                          lambda: [((), self.alerts.failed if self.alerts else 0)], kind='counter')
+        REGISTRY.function('collector_recorded_callbacks_total', 'Callbacks written to the callback log', (),
+                          lambda: [((), self.recorder.records if self.recorder else 0)], kind='counter')
+        REGISTRY.function('collector_restarts_total', 'Restarts of collector components', (),
+                          lambda: [((), self.restartCount())], kind='counter')
+
+    def restartCount(self):
+        return self.restarts + (self.supervisor.restartCount if self.supervisor else 0)
+
+    def statsLine(self):
+        # compact summary of the interval since the previous line
+        now = time.monotonic()
+        totals = dict(
+            samples=sum(data[ch].written for g in self.groups for data in g.buffers.values() for ch in data),
+            dropped=sum(data.dropped for g in self.groups for data in g.buffers.values()),
+            callback_sum=sum(child.sum for child in CALLBACK_TIME.children.values()),
+            callback_count=sum(child.count for child in CALLBACK_TIME.children.values()),
+            window_sum=sum(g.window_time.sum for g in self.groups),
+            window_count=sum(g.window_time.count for g in self.groups),
+            errors=sum(child.value for child in ERRORS.children.values()))
+        last, self._last_stats = self._last_stats, (now, totals)
+        if last is None:
+            return None
+        elapsed, delta = now - last[0], {k: totals[k] - last[1][k] for k in totals}
+        return ('[stats] {:.1f} samples/s, {} dropped, {} errors, callback {:.3f} ms, window {:.2f} ms, '
+                'missed {} late {} windows, sink queues {} (max lag {:.0f} s), restarts {}').format(
+                    delta['samples'] / elapsed, delta['dropped'], delta['errors'],
+                    1000 * delta['callback_sum'] / max(1, delta['callback_count']),
+                    1000 * delta['window_sum'] / max(1, delta['window_count']),
+                    self.scheduler.missed, self.scheduler.late, sum(len(sink.queue) for g in self.groups for sink in g.sinks),
+                    max((sink.lag() for g in self.groups for sink in g.sinks), default=0), self.restartCount())
+
+    def buildSupervisor(self):
+        # every part is restarted on its own when it fails, bricklets are set up again after a new connection
+        supervisor = Supervisor()
+        for connection in self.connections:
+            brickd = 'brickd {}'.format(connection.name)
+            supervisor.add(Component(brickd, connection.connect, connection.disconnect, connection.check))
+            for group in connection.groups:
+                for bricklet in BRICKLETS:
+                    if bricklet in group.uids:
+                        setup = group.setup(bricklet)
+                        supervisor.add(Component('{} {}'.format(group.name, bricklet),
+                                                 lambda setup=setup, connection=connection: setup(self.source, connection.ipcon),
+                                                 check=checkSamples(group.buffers[bricklet], self.config['stale_time']),
+                                                 requires=(brickd,)))
+        for group in self.groups:
+            for sink in group.sinks:
+                supervisor.add(Component('{} {}'.format(group.name, sink.name), sink.start,
+                                         lambda sink=sink: sink.stop(sink.timeout), checkSink(sink)))
+            if group.controller is not None:
+                supervisor.add(Component('{} adaptive sampling'.format(group.name), group.controller.start,
+                                         group.controller.stop, checkController(group.controller)))
+        if self.alerts is not None:
+            supervisor.add(Component('alerts', self.alerts.start, lambda: self.alerts.stop(1), checkAlerts(self.alerts)))
+        return supervisor
+
+    def processWindow(self, window_end):
+        for group in self.groups:
+            t0 = time.perf_counter()
+            try:
+                group.processWindow(window_end)
+                group.window_time.observe(time.perf_counter() - t0)
+            except Exception:
+                # a bad window must not take down the collector, the next one starts from fresh accumulators
+                group.errors['window'].inc()
+                print('[{}] Could not process window ending at [{}]:\n{}'.format(group.name, window_end, traceback.format_exc()))
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def run(self, stop_event):
+        if self.runs:
+            self.restarts += 1
+        self.runs += 1
+        if self.metrics_server is not None and self.runs == 1:
+            self.metrics_server.start()
+
+        self.supervisor = self.buildSupervisor()
+        for group in self.groups:
+            group.fault = self.supervisor.fault
+        self.supervisor.startAll()
+        self.supervisor.watch()
+
+        # sleep until the end of each wall clock aligned window
+        self.scheduler = scheduler = WindowScheduler(self.sample_time, stop_event)
+        next_stats = time.monotonic() + self.config['stats_interval']
+        self.statsLine()
+        try:
+            while True:
+                window = scheduler.wait()
+                if window is None:
+                    break
+                window_end, lateness, missed = window
+                if missed:
+                    print('Missed [{}] windows, woke up [{:.1f}] s late. Their samples are merged into this window.'.format(missed, lateness))
+
+                self.processWindow(window_end)
+
+                if self.config['stats_interval'] and time.monotonic() >= next_stats:
+                    next_stats += self.config['stats_interval']
+                    line = self.statsLine()
+                    if line is not None:
+                        print(line)
+        finally:
+            self.restarts += self.supervisor.restartCount
+            for group in self.groups:
+                group.fault = None
+            self.supervisor.stopAll()
+            self.supervisor = None
+            for group in self.groups:
+                for sink in group.sinks:
+                    sink.queue.flush()
+                if group.archive is not None:
+                    group.archive.flush()
+            if self.recorder is not None:
+                self.recorder.flush()
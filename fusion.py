@@ -0,0 +1,113 @@
+import numpy as np
+
+# Fusion of the same quantity measured by several bricklets. The raw samples of a window are aligned on a
+# common time grid (sample and hold), values far from the median of the other sensors are rejected and the
+# rest are averaged with weights from each sensor's noise variance, which is estimated online.
+
+FUSED = dict(
+    AVG_TEMP=(('air_quality', 'TEMP'), ('humidity', 'TEMP'), ('co2', 'TEMP')),
+    AVG_RH=(('air_quality', 'RH'), ('humidity', 'RH'), ('co2', 'RH')),
+)
+MIN_SPREAD = dict(AVG_TEMP=0.3, AVG_RH=1.5) # smallest robust spread between sensors, in °C and %RH
+MAX_POINTS = 2000 # grid points per window
+ALPHA = 0.1 # weight of the newest window in the noise estimate
+MAD_K = 3.5 # values further than MAD_K robust standard deviations from the median are rejected
+MAD_SCALE = 1.4826 # MAD of a normal distribution to its standard deviation
+MIN_NOISE = 0.25 # smallest noise standard deviation as a fraction of min_spread, a quantized or stuck sensor looks noiseless
+MAX_WEIGHT_RATIO = 10 # largest weight of a source relative to the smallest one
+
+
+class Fusion:
+    # fuses one quantity from the channels in sources, e.g. FUSED['AVG_TEMP']
+    def __init__(self, sources, min_spread, step=1.0, hold=None):
+        self.sources = sources
+        self.min_spread = min_spread
+        self.step = step
+        self.hold = hold # seconds a sample stays valid, None for the rest of the window
+        self.variance = np.full(len(sources), np.nan) # noise variance per source
+        self.min_variance = (MIN_NOISE * min_spread) ** 2
+        self.rejected = 0 # grid points dropped as outliers
+        self.missing = 0 # windows in which a source had no value
+        self._last = [None] * len(sources) # (timestamp, value) of the newest sample per source
+
+    def weights(self):
+        # inverse noise variance, equal weights until a source has an estimate. The floor and the
+        # ratio cap keep a frozen sensor from taking over the fused value with its zero variance.
+        variance = np.where(np.isnan(self.variance), np.nanmax(self.variance) if np.any(~np.isnan(self.variance)) else 1.0, self.variance)
+        weights = 1.0 / np.maximum(variance, self.min_variance)
+        return np.minimum(weights, MAX_WEIGHT_RATIO * weights.min())
+
+    def updateNoise(self, i, values):
+        # half the mean squared difference of consecutive samples, insensitive to slow drift
+        if len(values) < 3:
+            return
+        estimate = float(np.mean(np.diff(values) ** 2)) / 2
+        if np.isnan(self.variance[i]):
+            self.variance[i] = estimate
+        else:
+            self.variance[i] += ALPHA * (estimate - self.variance[i])
+
+    def align(self, windows, window_start, window_end):
+        # matrix of source x grid point values, NaN where a source has no valid sample
+        first = min([window_start] + [windows[s][c][0][0] for s, c in self.sources if s in windows and len(windows[s][c][0])])
+        n = max(1, min(MAX_POINTS, int(np.ceil((window_end - first) / self.step))))
+        grid = first + (np.arange(n) + 0.5) * (window_end - first) / n
+        aligned = np.full((len(self.sources), n), np.nan)
+        for i, (sensor, channel) in enumerate(self.sources):
+            ts, values = windows[sensor][channel] if sensor in windows else (np.zeros(0), np.zeros(0))
+            if self._last[i] is not None:
+                ts = np.concatenate(([self._last[i][0]], ts))
+                values = np.concatenate(([self._last[i][1]], values))
+            if len(ts) == 0:
+                continue
+            idx = np.searchsorted(ts, grid, side='right') - 1
+            valid = idx >= 0
+            if self.hold is not None:
+                valid &= grid - ts[np.maximum(idx, 0)] <= self.hold
+            aligned[i, valid] = values[idx[valid]]
+            self._last[i] = (ts[-1], values[-1])
+        return aligned
+
+    def fuse(self, windows, window_start, window_end):
+        # windows maps sensor to SensorBuffer.snapshot(), returns the fused window value or NaN
+        for i, (sensor, channel) in enumerate(self.sources):
+            if sensor in windows:
+                self.updateNoise(i, np.asarray(windows[sensor][channel][1]))
+        aligned = self.align(windows, window_start, window_end)
+        present = ~np.isnan(aligned)
+        self.missing += int(np.sum(~present.any(axis=1)))
+        if not present.any():
+            return float('nan')
+        points = present.any(axis=0)
+        aligned, present = aligned[:, points], present[:, points]
+
+        # robust outlier rejection per grid point, only where at least three sources can outvote one
+        count = present.sum(axis=0)
+        median = columnMedian(aligned, count)
+        deviation = np.abs(aligned - median)
+        spread = np.maximum(MAD_SCALE * columnMedian(deviation, count), self.min_spread)
+        outlier = present & (deviation > MAD_K * spread) & (count >= 3)
+        self.rejected += int(outlier.sum())
+        keep = present & ~outlier
+
+        weights = self.weights()[:, None] * keep
+        fused = (np.where(keep, aligned, 0.0) * weights).sum(axis=0) / weights.sum(axis=0)
+        return float(fused.mean())
+
+    def combine(self, means):
+        # noise weighted mean of per source window means for the longer rollups, NaN for missing sources
+        means = np.asarray(means, dtype=float)
+        present = ~np.isnan(means)
+        if not present.any():
+            return float('nan')
+        weights = self.weights()[present]
+        return float(np.sum(means[present] * weights) / np.sum(weights))
+
+
+def columnMedian(values, count):
+    # median of every column ignoring NaN, count is the number of values per column (at least one).
+    # np.sort puts NaN last, which is much cheaper than np.nanmedian for the few rows used here.
+    ordered = np.sort(values, axis=0)
+    low = np.take_along_axis(ordered, ((count - 1) // 2)[None, :], axis=0)[0]
+    high = np.take_along_axis(ordered, (count // 2)[None, :], axis=0)[0]
+    return (low + high) / 2
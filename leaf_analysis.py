@@ -0,0 +1,197 @@
+import os
+import csv
+import sys
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Batch analysis of the session files written by leaf_temp.py. Parsed sessions are cached in one
+# compressed file next to the data, keyed by file name, size and mtime, so a rerun only parses
+# new or changed sessions.
+#   python leaf_analysis.py [leaf_data] [--workers 4] [--csv sessions.csv]
+
+LEAF_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'leaf_data')
+CACHE_NAME = '.leaf_cache.npz'
+SESSION_PATTERN = '_leaf_temperatures.csv'
+POOL_MIN_FILES = 8 # fewer changed files are parsed in this process, a pool costs more than it saves
+
+SESSION_DTYPE = np.dtype([('name', 'U128'), ('mtime', '<i8'), ('size', '<i8')])
+LEAF_DTYPE = np.dtype([('session', '<u4'), ('time', '<f8'), ('leaf_id', '<i4'),
+                       ('leaf', '<f4'), ('amb', '<f4'),
+                       ('leaf_std', '<f4'), ('leaf_min', '<f4'), ('leaf_max', '<f4'), ('leaf_n', '<u4'),
+                       ('amb_std', '<f4'), ('amb_min', '<f4'), ('amb_max', '<f4'), ('amb_n', '<u4')])
+# csv column of every leaf field (leaf_temp.LEAF_FIELDS), sessions from before the running statistics only have the first four
+COLUMNS = dict(leaf_id='LEAF_ID', leaf='LEAF_TEMP', amb='AMB_LEAF_TEMP',
+               leaf_std='LEAF_TEMP_STD', leaf_min='LEAF_TEMP_MIN', leaf_max='LEAF_TEMP_MAX', leaf_n='LEAF_TEMP_N',
+               amb_std='AMB_LEAF_TEMP_STD', amb_min='AMB_LEAF_TEMP_MIN', amb_max='AMB_LEAF_TEMP_MAX', amb_n='AMB_LEAF_TEMP_N')
+DELTA_BINS = np.arange(-10, 10.5, 1.0) # °C, leaf minus ambient
+
+
+def parseSession(path):
+    # leaf rows of one session file as a LEAF_DTYPE array, the session column is filled in by the caller
+    rows = []
+    try:
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                if None in row.values():
+                    continue # shorter than the header, e.g. the last row of a crashed session
+                try:
+                    values = [0, datetime.strptime(row['TIME'], '%Y-%m-%d %H:%M:%S').timestamp()]
+                    for name, column in COLUMNS.items():
+                        value = row.get(column)
+                        missing = value in (None, '') # column not in the header of an older session, or left empty
+                        if LEAF_DTYPE[name].kind in 'iu':
+                            values.append(0 if missing else int(float(value)))
+                        else:
+                            values.append(np.nan if missing else float(value))
+                    rows.append(tuple(values))
+                except (KeyError, ValueError):
+                    continue # unreadable value
+    except (IOError, UnicodeDecodeError, csv.Error) as e:
+        print('Could not read session [{}]: {}'.format(path, e))
+    return np.array(rows, dtype=LEAF_DTYPE)
+
+
+def loadCache(path):
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=SESSION_DTYPE), np.zeros(0, dtype=LEAF_DTYPE)
+    try:
+        with np.load(path) as cache:
+            return cache['sessions'].astype(SESSION_DTYPE), cache['leaves'].astype(LEAF_DTYPE)
+    except Exception as e:
+        print('Ignoring unreadable cache [{}]: {!r}'.format(path, e))
+        return np.zeros(0, dtype=SESSION_DTYPE), np.zeros(0, dtype=LEAF_DTYPE)
+
+
+def saveCache(path, sessions, leaves):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, sessions=sessions, leaves=leaves)
+    os.replace(tmp, path)
+
+
+def scanSessions(leaf_dir):
+    sessions = []
+    for entry in os.scandir(leaf_dir):
+        if entry.is_file() and entry.name.endswith(SESSION_PATTERN):
+            stat = entry.stat()
+            sessions.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return np.array(sorted(sessions), dtype=SESSION_DTYPE)
+
+
+def loadSessions(leaf_dir, workers=None, cache_path=None):
+    # all sessions of leaf_dir with their leaves, only new or changed files are parsed
+    cache_path = cache_path or os.path.join(leaf_dir, CACHE_NAME)
+    cached_sessions, cached_leaves = loadCache(cache_path)
+    sessions = scanSessions(leaf_dir)
+
+    cached = {tuple(s): i for i, s in enumerate(cached_sessions.tolist())}
+    parts, todo = [None] * len(sessions), []
+    by_session = np.split(cached_leaves, np.searchsorted(cached_leaves['session'], np.arange(1, len(cached_sessions))))
+    for i, session in enumerate(sessions.tolist()):
+        if session in cached:
+            parts[i] = by_session[cached[session]]
+        else:
+            todo.append(i)
+
+    paths = [os.path.join(leaf_dir, sessions['name'][i]) for i in todo]
+    if len(paths) >= POOL_MIN_FILES and workers != 1:
+        with ProcessPoolExecutor(workers) as pool:
+            parsed = list(pool.map(parseSession, paths, chunksize=max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))))
+    else:
+        parsed = [parseSession(path) for path in paths]
+    for i, leaves in zip(todo, parsed):
+        parts[i] = leaves
+
+    # sessions are numbered by their position, so the cached leaves stay sorted by session
+    for i, leaves in enumerate(parts):
+        leaves['session'] = i
+    leaves = np.concatenate(parts) if parts else np.zeros(0, dtype=LEAF_DTYPE)
+    if todo or len(sessions) != len(cached_sessions):
+        saveCache(cache_path, sessions, leaves)
+    return sessions, leaves, len(todo)
+
+
+def trend(x, y):
+    # slope of a least squares line, NaN with less than two distinct x values
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if valid.sum() < 2 or np.ptp(x[valid]) == 0:
+        return np.nan
+    return float(np.polyfit(x[valid], y[valid], 1)[0])
+
+
+def sessionSummaries(sessions, leaves):
+    # one row per session: leaves, mean temperatures, leaf to ambient delta statistics and the delta trend per hour
+    delta = leaves['leaf'].astype(np.float64) - leaves['amb']
+    bounds = np.searchsorted(leaves['session'], np.arange(len(sessions) + 1))
+    summaries = []
+    for i, name in enumerate(sessions['name']):
+        lo, hi = bounds[i], bounds[i + 1]
+        d, t = delta[lo:hi], leaves['time'][lo:hi]
+        summaries.append(dict(
+            session=name, start=datetime.fromtimestamp(t.min()).strftime('%Y-%m-%d %H:%M') if hi > lo else '',
+            leaves=int(hi - lo),
+            leaf=float(np.nanmean(leaves['leaf'][lo:hi])) if hi > lo else np.nan,
+            amb=float(np.nanmean(leaves['amb'][lo:hi])) if hi > lo else np.nan,
+            delta=float(np.nanmean(d)) if hi > lo else np.nan,
+            delta_std=float(np.nanstd(d)) if hi > lo else np.nan,
+            delta_min=float(np.nanmin(d)) if hi > lo else np.nan,
+            delta_max=float(np.nanmax(d)) if hi > lo else np.nan,
+            trend_per_h=trend((t - t.min()) / 3600.0, d) if hi > lo else np.nan))
+    return summaries
+
+
+def overallSummary(summaries, leaves):
+    # distribution of all leaf deltas and the trend of the session mean delta per week
+    delta = (leaves['leaf'].astype(np.float64) - leaves['amb'])
+    delta = delta[~np.isnan(delta)]
+    starts = np.array([datetime.strptime(s['start'], '%Y-%m-%d %H:%M').timestamp() if s['start'] else np.nan for s in summaries])
+    means = np.array([s['delta'] for s in summaries])
+    return dict(sessions=len(summaries), leaves=len(leaves),
+                percentiles=dict(zip((5, 25, 50, 75, 95), np.percentile(delta, (5, 25, 50, 75, 95)) if len(delta) else [np.nan] * 5)),
+                mean=float(delta.mean()) if len(delta) else np.nan,
+                std=float(delta.std()) if len(delta) else np.nan,
+                histogram=np.histogram(np.clip(delta, DELTA_BINS[0], DELTA_BINS[-1]), DELTA_BINS)[0],
+                trend_per_week=trend(starts / (7 * 86400.0), means))
+
+
+def printReport(summaries, overall):
+    print('{:<44} {:>16} {:>6} {:>7} {:>7} {:>7} {:>6} {:>7} {:>7} {:>9}'.format(
+        'session', 'start', 'leaves', 'leaf', 'amb', 'delta', 'std', 'min', 'max', 'trend/h'))
+    for s in summaries:
+        print('{session:<44} {start:>16} {leaves:>6} {leaf:>7.2f} {amb:>7.2f} {delta:>7.2f} {delta_std:>6.2f} '
+              '{delta_min:>7.2f} {delta_max:>7.2f} {trend_per_h:>9.3f}'.format(**s))
+
+    print('\n[{sessions}] sessions, [{leaves}] leaves, leaf - ambient [{mean:.2f}] ± [{std:.2f}] °C, '
+          'trend of the session means [{trend_per_week:+.3f}] °C per week'.format(**overall))
+    print('percentiles: ' + ', '.join('p{}={:.2f}'.format(p, v) for p, v in overall['percentiles'].items()))
+    peak = max(1, overall['histogram'].max())
+    for lo, count in zip(DELTA_BINS, overall['histogram']):
+        print('{:>5.0f} .. {:>3.0f} °C {:>7} {}'.format(lo, lo + 1, count, '#' * int(round(40 * count / peak))))
+
+
+def writeSummaries(path, summaries):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(summaries[0]) if summaries else ['session'])
+        writer.writeheader()
+        writer.writerows(summaries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summaries of all leaf temperature sessions.')
+    parser.add_argument('leaf_dir', nargs='?', default=LEAF_DIR, help='directory of session files')
+    parser.add_argument('--workers', type=int, help='parser processes, default one per CPU')
+    parser.add_argument('--cache', help='cache file, default {} in leaf_dir'.format(CACHE_NAME))
+    parser.add_argument('--csv', help='write the per session summaries to this file')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.leaf_dir):
+        sys.exit('No session directory [{}]'.format(args.leaf_dir))
+    sessions, leaves, parsed = loadSessions(args.leaf_dir, args.workers, args.cache)
+    print('Parsed [{}] new or changed sessions, [{}] from cache.\n'.format(parsed, len(sessions) - parsed))
+    summaries = sessionSummaries(sessions, leaves)
+    printReport(summaries, overallSummary(summaries, leaves))
+    if args.csv:
+        writeSummaries(args.csv, summaries)
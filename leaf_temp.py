@@ -1,19 +1,15 @@
+import io
 import time
 import os, sys
 import csv
-import numpy as np
-import pandas as pd
+import threading
 from datetime import datetime
 
-import statistics as stats
-import thingspeak
-import requests as req
 from tinkerforge.ip_connection import IPConnection
-from tinkerforge.bricklet_air_quality import BrickletAirQuality
-from tinkerforge.bricklet_air_quality import BrickletAirQuality
-from tinkerforge.bricklet_humidity_v2 import BrickletHumidityV2
 from tinkerforge.bricklet_temperature_ir_v2 import BrickletTemperatureIRV2
 
+from rollup import Accumulator, roundSignificant
+
 HOST = "localhost"
 PORT = 4223
 UID_IT = "Ls8" # UID of IR temperature sensor
@@ -23,8 +19,14 @@ CALLBACK_PERIOD = 500 # sensor callback function time in milliseconds
 SAMPLE_TIME = 20
 LEAF_COUNT = 0
 
-_CURRENT_IRT_DATA = dict(OBJ_TEMP=[], AMB_TEMP=[])
-_LEAF_TEMP_DATA = [] #dict()#LEAF_ID=[], TIME=[], LEAF_TEMP=[], AMB_LEAF_TEMP=[])
+# running statistics of the current leaf, replaced by fresh accumulators for every leaf
+_CURRENT_IRT_DATA = dict(OBJ_TEMP=Accumulator(), AMB_TEMP=Accumulator())
+_IRT_LOCK = threading.Lock()
+
+# one row per leaf, appended to the session file as soon as the leaf is done
+LEAF_FIELDS = ['TIME', 'LEAF_ID', 'LEAF_TEMP', 'AMB_LEAF_TEMP',
+               'LEAF_TEMP_STD', 'LEAF_TEMP_MIN', 'LEAF_TEMP_MAX', 'LEAF_TEMP_N',
+               'AMB_LEAF_TEMP_STD', 'AMB_LEAF_TEMP_MIN', 'AMB_LEAF_TEMP_MAX', 'AMB_LEAF_TEMP_N']
 
 START_TIME = datetime.now()
 
@@ -38,58 +40,141 @@ def cb_connected(connect_reason):
 
 def cb_object_temperature(temperature):
     if RECORD_DATA:
-        _CURRENT_IRT_DATA['OBJ_TEMP'].append(temperature/10)
+        with _IRT_LOCK:
+            _CURRENT_IRT_DATA['OBJ_TEMP'].add(temperature/10)
 
 
 def cb_ambient_temperature(temperature):
     if RECORD_DATA:
-        _CURRENT_IRT_DATA['AMB_TEMP'].append(temperature/10)
+        with _IRT_LOCK:
+            _CURRENT_IRT_DATA['AMB_TEMP'].add(temperature/10)
 
 
-def insertToLeafDF(data_to_insert, _LEAF_TEMP_DATA=_LEAF_TEMP_DATA):
-    _LEAF_TEMP_DATA.append({
-        'TIME': datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), 
-        'LEAF_ID': str(LEAF_COUNT),
-        'LEAF_TEMP': data_to_insert['OBJ_TEMP'], 
-        'AMB_LEAF_TEMP': data_to_insert['AMB_TEMP']
-        })
-    
-    # reset data containers
-    _CURRENT_IRT_DATA = dict(OBJ_TEMP=[], AMB_TEMP=[])
-
-
-def getLeafWindowedMeanTemp(window_data):
-    mean_data = {}
-    # calculate mean only for numeric keys. Take last element for others.
-    for key in window_data:
-        if len(window_data[key]) > 1 and isinstance(window_data[key][0], (float, int)):
-            mean_data[key] = float(np.format_float_positional( stats.mean(window_data[key]), precision=4, unique=False, fractional=False, trim='k') )
-        else:
-            mean_data[key] = window_data[key][-1]
-
-    return mean_data
+def takeLeafData():
+    # hand over the statistics of the finished leaf and start the next one from zero
+    global _CURRENT_IRT_DATA
+    with _IRT_LOCK:
+        leaf_data = _CURRENT_IRT_DATA
+        _CURRENT_IRT_DATA = dict(OBJ_TEMP=Accumulator(), AMB_TEMP=Accumulator())
+    return leaf_data
 
 
-def saveData(data_to_save):
-    # save all collected data for current script run as a csv file with the timestamp
+def getLeafRow(leaf_data):
+    obj, amb = leaf_data['OBJ_TEMP'], leaf_data['AMB_TEMP']
+    return {
+        'TIME': datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), 
+        'LEAF_ID': str(LEAF_COUNT),
+        'LEAF_TEMP': roundSignificant(obj.mean), 
+        'AMB_LEAF_TEMP': roundSignificant(amb.mean),
+        'LEAF_TEMP_STD': roundSignificant(obj.std),
+        'LEAF_TEMP_MIN': obj.min,
+        'LEAF_TEMP_MAX': obj.max,
+        'LEAF_TEMP_N': obj.count,
+        'AMB_LEAF_TEMP_STD': roundSignificant(amb.std),
+        'AMB_LEAF_TEMP_MIN': amb.min,
+        'AMB_LEAF_TEMP_MAX': amb.max,
+        'AMB_LEAF_TEMP_N': amb.count,
+        }
+
+
+class LeafSession:
+    # session CSV file, every leaf row is flushed to disk right away so a crash loses at most the current leaf
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.leaf_count = 0 # leaf rows in the file
+        self.last_id = 0 # highest leaf id in the file, numbering continues after it
+        resume = os.path.exists(file_path) and os.path.getsize(file_path) > 0
+        if resume:
+            self._resume()
+        self._file = open(file_path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=LEAF_FIELDS, extrasaction='ignore')
+        if not resume:
+            self._writer.writeheader()
+            self._flush()
+
+    def _resume(self):
+        # read the leaves saved by the interrupted session. A row cut off by a crash or otherwise unreadable
+        # is removed from the file, so the analysis sees the same leaves as the resumed session.
+        with open(self.file_path, newline='') as f:
+            text = f.read()
+        torn = not text.endswith(('\r', '\n'))
+        if torn:
+            text = text[:text.rfind('\n') + 1]
+        reader = csv.DictReader(io.StringIO(text, newline=''))
+        fieldnames = reader.fieldnames or []
+        if 'LEAF_ID' not in fieldnames or not set(fieldnames) <= set(LEAF_FIELDS):
+            raise ValueError('{} has the columns {}, not the ones of a leaf session'.format(self.file_path, fieldnames))
+        rows, skipped = [], int(torn)
+        for row in reader:
+            try:
+                if None in row.values():
+                    raise ValueError('missing columns')
+                leaf_id = int(row['LEAF_ID'])
+            except ValueError:
+                skipped += 1
+                continue
+            rows.append(row)
+            self.last_id = max(self.last_id, leaf_id)
+        self.leaf_count = len(rows)
+
+        if skipped:
+            print('Removing [{}] unreadable rows from file: {}'.format(skipped, self.file_path))
+        if fieldnames != LEAF_FIELDS:
+            # session of an older version with fewer statistics, rewritten with the current header
+            print('Adding the columns {} to file: {}'.format([f for f in LEAF_FIELDS if f not in fieldnames], self.file_path))
+        if skipped or fieldnames != LEAF_FIELDS:
+            tmp = self.file_path + '.tmp'
+            with open(tmp, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=LEAF_FIELDS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.file_path)
+
+    def writeLeaf(self, row):
+        self._writer.writerow(row)
+        self._flush()
+        self.leaf_count += 1
+
+    def _flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def newSessionPath():
+    # new csv file for the current script run, named with the timestamp
     file_name = datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S') + '_leaf_temperatures.csv'
     file_name = file_name.replace(' ', '_')
     script_dir = '/'.join(os.path.realpath(__file__).split('/')[:-1])
-    file_path = os.path.join(script_dir, 'leaf_data', file_name)
+    os.makedirs(os.path.join(script_dir, 'leaf_data'), exist_ok=True)
+    return os.path.join(script_dir, 'leaf_data', file_name)
 
-    # create file if not existing to prevent accidental overwrite
+
+def saveLeaf(session):
+    # average all temp measurements of the current leaf and append them to the session file
+    leaf_data = takeLeafData()
+    if leaf_data['OBJ_TEMP'].count == 0 or leaf_data['AMB_TEMP'].count == 0:
+        print('No data collected for leaf: {}. Nothing to save.'.format(LEAF_COUNT))
+        return
     try:
-        with open(file_path, 'w') as f:
-            w = csv.DictWriter(f, fieldnames=data_to_save[0].keys())
-            w.writeheader()
-            for leaf_data in data_to_save:
-                w.writerow(leaf_data)
-        print('Saving data for [{}] leafs in file: {}. Exiting.'.format(len(_LEAF_TEMP_DATA), file_name))
+        session.writeLeaf(getLeafRow(leaf_data))
     except IOError:
-        print('Unknown IO Error. Could not save file: {}.'.format(file_name))
+        print('Unknown IO Error. Could not save leaf {} in file: {}.'.format(LEAF_COUNT, session.file_path))
 
 
 if __name__ == "__main__":
+    # resume an interrupted session with: python leaf_temp.py leaf_data/<session>.csv
+    try:
+        session = LeafSession(sys.argv[1] if len(sys.argv) > 1 else newSessionPath())
+    except ValueError as e:
+        sys.exit('Could not resume session: {}'.format(e))
+    LEAF_COUNT = session.last_id
+    print('Saving leaf data in file: {}'.format(session.file_path))
+
     # Create IP connection
     ipcon = IPConnection() 
 
@@ -107,6 +192,10 @@ if __name__ == "__main__":
     it.register_callback(it.CALLBACK_OBJECT_TEMPERATURE, cb_object_temperature)
     it.register_callback(it.CALLBACK_AMBIENT_TEMPERATURE, cb_ambient_temperature)
 
+    # the callbacks are disabled until a period is set
+    it.set_object_temperature_callback_configuration(CALLBACK_PERIOD, False, 'x', 0, 0)
+    it.set_ambient_temperature_callback_configuration(CALLBACK_PERIOD, False, 'x', 0, 0)
+
     user_in_old = 'init'
     while True:
         print('current leaf: {}'.format(LEAF_COUNT))
@@ -114,46 +203,31 @@ if __name__ == "__main__":
         user_in_new = input("Enter any of the below choices: \n\t 1. [Y] to record temp for leaf {}. \n\t 3. [L]eaf for next leaf (will save data for leaf: {}). \n\t 3. [N]o to exit code.\n".format(LEAF_COUNT, LEAF_COUNT))
         
         # check input and continue accordingly. Exit only when user specifies.
-        if 'Y' == user_in_new.upper() and LEAF_COUNT == 0:
+        if 'Y' == user_in_new.upper() and not RECORD_DATA:
             LEAF_COUNT += 1
             # set flag to start collecting data
+            takeLeafData()
             RECORD_DATA = True
             print('\n\tSensor is recording data for leaf: [{}] . . .'.format(LEAF_COUNT))
-        elif 'L' in user_in_new.upper():
-            # reset flag for next leaf
-            RECORD_DATA = False 
-
-            # average all temp measurements and add to leaf DF
-            if len(_CURRENT_IRT_DATA) != 0:
-                avg_measurements = getLeafWindowedMeanTemp(_CURRENT_IRT_DATA)
-                insertToLeafDF(avg_measurements)
-            else:
-                print('No data collected for leaf: {}. Nothing to save.'.format(LEAF_COUNT))
-            
-            # start collecting data for next leaf
-            RECORD_DATA = True
+        elif 'L' in user_in_new.upper() and RECORD_DATA:
+            # save current leaf right away and start collecting data for next leaf
+            saveLeaf(session)
             LEAF_COUNT += 1
             print('\n\tSensor is recording data for leaf: [{}] . . .'.format(LEAF_COUNT))
         elif 'N' == user_in_new.upper():
-            RECORD_DATA = False
-
             # check if any buffered data needs to be saved.
-            if len(_CURRENT_IRT_DATA) != 0:
-                # average measurements for current window 
-                avg_measurements = getLeafWindowedMeanTemp(_CURRENT_IRT_DATA)
-                insertToLeafDF(avg_measurements)
-                saveData(_LEAF_TEMP_DATA)
-                break   
-            else:
-                print('No data to save. Exiting.')
-                break
-        elif 'Y' == user_in_new.upper() and LEAF_COUNT > 0:
+            if RECORD_DATA:
+                RECORD_DATA = False
+                saveLeaf(session)
+            print('Saved data for [{}] leafs in file: {}. Exiting.'.format(session.leaf_count, session.file_path))
+            break
+        elif 'Y' == user_in_new.upper() and RECORD_DATA:
             print("Wrong choice. Already started recording data. Enter only: [N,n,L, or l].\n\n")
         else:
             print("Wrong choice. Enter only: [Y,y,N,n,L, or l].\n\n")
         
         user_in_old = user_in_new
 
+    session.close()
     ipcon.disconnect()
     print("Main script.")
-
@@ -0,0 +1,146 @@
+import bisect
+import threading
+
+# Counters and histograms for the collector. Children for a label combination are created once and
+# cached, so the hot path only does an attribute increment. Values that already exist elsewhere
+# (buffer counts, queue depth, restarts) are read through functions when metrics are rendered.
+
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+METRICS_HOST = '127.0.0.1'
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+
+class Metric:
+    def __init__(self, kind, name, help, labelnames, buckets=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.children = {}
+        self._lock = threading.Lock()
+        self._default = self.labels() if not self.labelnames else None
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = HistogramChild(self.buckets) if self.kind == 'histogram' else CounterChild()
+                    self.children[values] = child
+        return child
+
+    def inc(self, n=1):
+        self._default.inc(n)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.functions = {} # name -> (kind, help, labelnames, function returning [(labelvalues, value)])
+
+    def counter(self, name, help, labelnames=()):
+        return self.metrics.setdefault(name, Metric('counter', name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        return self.metrics.setdefault(name, Metric('histogram', name, help, labelnames, tuple(buckets)))
+
+    def function(self, name, help, labelnames, function, kind='gauge'):
+        # metric read from existing state when rendered, kind is 'gauge' or 'counter'
+        self.functions[name] = (kind, help, tuple(labelnames), function)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for values, child in list(metric.children.items()):
+                labels = list(zip(metric.labelnames, values))
+                if metric.kind == 'counter':
+                    lines.append('{}{} {}'.format(metric.name, formatLabels(labels), child.value))
+                    continue
+                cumulative = 0
+                for le, count in zip(metric.buckets + ('+Inf',), child.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(metric.name, formatLabels(labels + [('le', le)]), cumulative))
+                lines.append('{}_sum{} {}'.format(metric.name, formatLabels(labels), child.sum))
+                lines.append('{}_count{} {}'.format(metric.name, formatLabels(labels), child.count))
+        for name, (kind, help, labelnames, function) in list(self.functions.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for values, value in function():
+                lines.append('{}{} {}'.format(name, formatLabels(list(zip(labelnames, values))), value))
+        return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    # serves REGISTRY on http://127.0.0.1:<port>/metrics from a background thread
+    def __init__(self, port, registry=REGISTRY, host=METRICS_HOST):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
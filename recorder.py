@@ -0,0 +1,75 @@
+import os
+import time
+import struct
+import threading
+
+import numpy as np
+
+# Log of every raw bricklet callback, written when record_dir is set. Each invocation is one fixed-size
+# record with the monotonic time, bricklet uid and type, callback id and the integer arguments before
+# scaling, so replay.py can feed them through the collector again. A new file is started every
+# segment_time seconds, the header maps its monotonic timestamps to the wall clock.
+#   <record_dir>/<segment start in ms>.aqr
+
+RECORD_MAGIC = b'AQR1'
+HEADER = struct.Struct('<4sIdd') # magic, record size, wall clock and monotonic time at the start of the file
+MAX_ARGS = 5 # all values of the air quality bricklet
+RECORD = struct.Struct('<d8sHBB{}i'.format(MAX_ARGS)) # monotonic time, uid, device identifier, callback id, argument count, arguments
+RECORD_DTYPE = np.dtype([('ts', '<f8'), ('uid', 'S8'), ('device', '<u2'), ('callback', 'u1'), ('count', 'u1'), ('args', '<i4', MAX_ARGS)])
+SEGMENT_TIME = 3600 # seconds of callbacks per log file
+BUFFER_SIZE = 1 << 16 # bytes buffered before a write, flush() is called once per window
+PADDING = (0,) * MAX_ARGS
+
+
+class CallbackRecorder:
+    # appends records from all callback threads, only packing and a buffered write happen per callback
+    def __init__(self, path, segment_time=SEGMENT_TIME):
+        self.path = path
+        self.segment_time = segment_time
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._end = None
+        os.makedirs(path, exist_ok=True)
+
+    def record(self, uid, device_identifier, callback_id, args):
+        ts = time.monotonic()
+        with self._lock:
+            if self._file is None or ts >= self._end:
+                self._rotate(ts)
+            self._file.write(RECORD.pack(ts, uid.encode(), device_identifier, callback_id, len(args), *(tuple(args) + PADDING)[:MAX_ARGS]))
+            self.records += 1
+
+    def _rotate(self, mono):
+        if self._file is not None:
+            self._file.close()
+        wall = time.time() - (time.monotonic() - mono)
+        self._file = open(os.path.join(self.path, '{}.aqr'.format(int(wall * 1000))), 'wb', buffering=BUFFER_SIZE)
+        self._file.write(HEADER.pack(RECORD_MAGIC, RECORD.size, wall, mono))
+        self._end = mono + self.segment_time
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def readRecords(path):
+    # RECORD_DTYPE array of one log file and the wall clock time of every record,
+    # a record cut off by a crash at the end of the file is ignored
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return np.zeros(0, dtype=RECORD_DTYPE), np.zeros(0)
+        magic, size, wall, mono = HEADER.unpack(header)
+        if magic != RECORD_MAGIC or size != RECORD_DTYPE.itemsize:
+            raise ValueError('{} is not a callback log'.format(path))
+        count = (os.fstat(f.fileno()).st_size - HEADER.size) // size
+        records = np.fromfile(f, dtype=RECORD_DTYPE, count=count)
+    return records, wall + (records['ts'] - mono)
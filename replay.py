@@ -0,0 +1,162 @@
+import io
+import os
+import sys
+import math
+import time
+import argparse
+import contextlib
+
+import numpy as np
+
+from recorder import readRecords, RECORD_DTYPE
+from archive import parseTime
+from collector import Collector, loadConfig, ERRORS
+
+# Offline reprocessing of callback logs written with record_dir. The raw arguments are passed to the
+# callbacks of the collector with their logged timestamps and windows are closed by the logged time, so
+# aggregation, fusion, rollups and sinks run exactly as they did live, only as fast as the CPU allows.
+# This recomputes past windows after changing sample_time or the fusion, backfills a new sink or
+# tries out alert rules on recorded data, alerts are raised with the logged time.
+#   python replay.py collector.json record/*.aqr [--sample-time 60] [--sinks csv] [--out-dir replay]
+
+MAX_GAP = 300 # seconds without callbacks after which the empty windows in between are skipped, the collector was not running
+OUT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'replay')
+
+
+def loadRecords(paths, start=0, end=float('inf')):
+    # records of all logs in time order, with the wall clock time of every record
+    parts = [readRecords(path) for path in paths]
+    if not parts:
+        return np.zeros(0, dtype=RECORD_DTYPE), np.zeros(0)
+    records = np.concatenate([records for records, _ in parts])
+    wall = np.concatenate([wall for _, wall in parts])
+    order = np.argsort(wall, kind='stable')
+    records, wall = records[order], wall[order]
+    keep = (wall >= start) & (wall < end)
+    return records[keep], wall[keep]
+
+
+def matchCallbacks(collector, records):
+    # callback function for every logged (uid, callback id), bricklets without a configured uid
+    # are matched by their type like during enumeration
+    callbacks = {}
+    unknown = set()
+    for uid, device, callback_id in sorted(set(zip(records['uid'].tolist(), records['device'].tolist(), records['callback'].tolist()))):
+        uid = uid.decode()
+        for connection in collector.connections:
+            bricklet = connection.device_types.get(device)
+            group = connection.findGroup(uid, bricklet) if bricklet is not None else None
+            if group is not None and (bricklet, callback_id) in group.callbacks:
+                callbacks[uid, callback_id] = group.callbacks[bricklet, callback_id]
+                break
+        else:
+            unknown.add(uid)
+    if unknown:
+        print('[replay] Skipping callbacks of bricklets without group: {}'.format(', '.join(sorted(unknown))))
+    return callbacks
+
+
+def replay(collector, records, wall, max_gap=MAX_GAP):
+    # feeds all records through the callbacks and closes every window on the way, returns the number of windows
+    sample_time = collector.sample_time
+    if len(records) == 0:
+        return 0
+    callbacks = matchCallbacks(collector, records)
+    uids = [uid.decode() for uid in records['uid'].tolist()]
+    windows = 0
+    window_end = (math.floor(wall[0] / sample_time) + 1) * sample_time
+    for ts, uid, callback_id, count, args in zip(wall.tolist(), uids, records['callback'].tolist(),
+                                                  records['count'].tolist(), records['args'].tolist()):
+        if ts >= window_end:
+            if ts - window_end > max_gap:
+                collector.processWindow(window_end)
+                windows += 1
+                window_end = (math.floor(ts / sample_time) + 1) * sample_time
+            while ts >= window_end:
+                collector.processWindow(window_end)
+                windows += 1
+                window_end += sample_time
+        callback = callbacks.get((uid, callback_id))
+        if callback is not None:
+            callback(*args[:count], ts=ts)
+    collector.processWindow(window_end)
+    return windows + 1
+
+
+def drain(collector, timeout=None):
+    # waits until every sink wrote its queue, False when the timeout passed first
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while any(len(sink.queue) for group in collector.groups for sink in group.sinks):
+        if deadline is not None and time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompute windows from callback logs with the collector.')
+    parser.add_argument('config', help='collector config file, its groups and bricklet uids are matched to the logs')
+    parser.add_argument('logs', nargs='+', help='callback logs (.aqr) written with record_dir')
+    parser.add_argument('--sample-time', type=int, help='window length in seconds, default from the config')
+    parser.add_argument('--sinks', nargs='+', help='names of the sinks to write to, default all sinks of each group')
+    parser.add_argument('--out-dir', default=OUT_DIR, help='spool, csv and sqlite directory, kept apart from the live collector')
+    parser.add_argument('--archive', action='store_true', help='also write the raw samples to <out-dir>/archive')
+    parser.add_argument('--start', type=parseTime, default=0, help='ISO date or unix time')
+    parser.add_argument('--end', type=parseTime, default=float('inf'), help='ISO date or unix time')
+    parser.add_argument('--timeout', type=float, help='seconds to wait for the sinks after the replay, default until written')
+    parser.add_argument('--verbose', action='store_true', help='print every window')
+    args = parser.parse_args()
+
+    config = loadConfig(args.config)
+    config.update(spool_dir=args.out_dir, metrics_port=None, record_dir=None,
+                  archive_dir=os.path.join(args.out_dir, 'archive') if args.archive else None)
+    if args.sample_time:
+        # rollups have to be multiples of the new window length
+        config['sample_time'] = args.sample_time
+        config['rollup_resolutions'] = [r for r in config['rollup_resolutions'] if r % args.sample_time == 0]
+    for connection in config['connections']:
+        for group in connection['groups']:
+            if args.sinks:
+                group['sinks'] = [sink for sink in group['sinks'] if sink.get('name', sink['type']) in args.sinks]
+            for sink in group['sinks']:
+                # relative sink paths of the live config end up in the output directory
+                if 'path' in sink and not os.path.isabs(sink['path']):
+                    sink['path'] = os.path.join(args.out_dir, sink['path'])
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    records, wall = loadRecords(args.logs, args.start, args.end)
+    loaded = time.perf_counter() - t0
+    if len(records) == 0:
+        sys.exit('No callbacks in the given logs and time range')
+
+    collector = Collector(config)
+    for group in collector.groups:
+        for sink in group.sinks:
+            # all windows are known up front, partial batches need not wait for more
+            sink.max_delay = 0
+            sink.start()
+
+    t0 = time.perf_counter()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        windows = replay(collector, records, wall)
+    elapsed = time.perf_counter() - t0
+    span = wall[-1] - wall[0]
+    print('[replay] [{}] callbacks over [{:.0f}] s in [{}] windows of [{}] s, loaded in [{:.2f}] s, replayed in [{:.2f}] s, '
+          '[{:.0f}] times real time, [{}] errors'.format(len(records), span, windows, collector.sample_time, loaded,
+                                                         elapsed, span / max(elapsed, 1e-9), int(sum(c.value for c in ERRORS.children.values()))))
+
+    if collector.alerts is not None:
+        # alerts were queued during the replay and are delivered now, outside of the captured output
+        collector.alerts.start()
+        collector.alerts.stop()
+    written = drain(collector, args.timeout)
+    for group in collector.groups:
+        for sink in group.sinks:
+            sink.stop(sink.timeout)
+            sink.queue.flush()
+            print('[replay] [{}] [{}] wrote [{}] windows{}'.format(group.name, sink.name, sink.written,
+                                                               '' if written else ', [{}] still queued'.format(len(sink.queue))))
+        if group.archive is not None:
+            group.archive.flush()
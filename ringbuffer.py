@@ -0,0 +1,83 @@
+import time
+import threading
+import numpy as np
+
+
+class RingBuffer:
+    # fixed capacity buffer of (timestamp, value) samples for one sensor channel.
+    # Storage is allocated once; appends only write into the preallocated arrays.
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = int(capacity)
+        self._ts = np.zeros(self.capacity, dtype=np.float64)
+        self._values = np.zeros(self.capacity, dtype=dtype)
+        self._written = 0   # total number of samples ever written
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    @property
+    def written(self):
+        return self._written
+
+    def append(self, value, ts=None):
+        if ts is None:
+            ts = time.time()
+        with self._lock:
+            idx = self._written % self.capacity
+            self._ts[idx] = ts
+            self._values[idx] = value
+            self._written += 1
+
+    def readSince(self, cursor):
+        # return (timestamps, values, new_cursor, dropped) for all samples written after cursor.
+        # Samples overwritten before they were read are reported as dropped.
+        with self._lock:
+            end = self._written
+            start = max(cursor, end - self.capacity)
+            dropped = start - cursor
+            n = end - start
+            first = start % self.capacity
+            if first + n <= self.capacity:
+                ts = self._ts[first:first + n].copy()
+                values = self._values[first:first + n].copy()
+            else:
+                split = self.capacity - first
+                ts = np.concatenate((self._ts[first:], self._ts[:n - split]))
+                values = np.concatenate((self._values[first:], self._values[:n - split]))
+        return ts, values, end, dropped
+
+    def latest(self):
+        with self._lock:
+            if self._written == 0:
+                return None
+            idx = (self._written - 1) % self.capacity
+            return self._ts[idx], self._values[idx]
+
+
+class SensorBuffer:
+    # group of ring buffers, one per channel of a sensor, read together as one window
+    def __init__(self, channels, capacity):
+        self.channels = tuple(channels)
+        self._buffers = {ch: RingBuffer(capacity) for ch in self.channels}
+        self._cursors = {ch: 0 for ch in self.channels}
+        self.dropped = 0
+
+    def __getitem__(self, channel):
+        return self._buffers[channel]
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def append(self, channel, value, ts=None):
+        self._buffers[channel].append(value, ts)
+
+    def snapshot(self):
+        # samples of every channel written since the previous snapshot. The callback thread keeps
+        # writing into the same buffers, later samples simply land in the next snapshot.
+        window = {}
+        for ch in self.channels:
+            ts, values, self._cursors[ch], dropped = self._buffers[ch].readSince(self._cursors[ch])
+            self.dropped += dropped
+            window[ch] = (ts, values)
+        return window
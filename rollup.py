@@ -0,0 +1,166 @@
+import math
+
+# numpy is only imported by the functions working on whole windows, so leaf_temp.py can use the
+# Accumulator without loading it
+
+RESOLUTIONS = (20, 60, 900, 3600) # window lengths in seconds, each a multiple of the previous one
+
+
+def roundSignificant(value, digits=4):
+    # value rounded to digits significant digits, without formatting it to a string and back
+    if value == 0 or not math.isfinite(value):
+        return float(value)
+    return round(float(value), digits - 1 - math.floor(math.log10(abs(value))))
+
+
+class Accumulator:
+    # streaming statistics of one channel: count, sum, min, max, Welford mean/variance and last value.
+    # weight and wsum hold the time-weighted sum, for samples that arrive at irregular intervals.
+    __slots__ = ('count', 'sum', 'min', 'max', 'mean', 'm2', 'last', 'weight', 'wsum')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last = None
+        self.weight = 0.0
+        self.wsum = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.last = value
+
+    def addArray(self, values):
+        # add a block of samples at once, merged in with the parallel variance formula
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self._combine(n, float(values.sum()), float(values.min()), float(values.max()), mean, m2, float(values[-1]))
+
+    def addWeighted(self, values, weights):
+        # values held for weights seconds each, scalars or arrays
+        import numpy as np
+        self.wsum += float(np.sum(np.multiply(values, weights)))
+        self.weight += float(np.sum(weights))
+
+    def merge(self, other):
+        if other.count:
+            self._combine(other.count, other.sum, other.min, other.max, other.mean, other.m2, other.last)
+        self.weight += other.weight
+        self.wsum += other.wsum
+
+    def _combine(self, n, total, vmin, vmax, mean, m2, last):
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta * delta * self.count * n / count
+        self.count = count
+        self.sum += total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+        self.last = last
+
+    @property
+    def timeMean(self):
+        # mean weighted by how long each value was held, the plain mean when no durations are known
+        return self.wsum / self.weight if self.weight > 0 else self.mean
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class RollupEngine:
+    # keeps one accumulator per channel and resolution. Samples only enter the shortest window,
+    # which is merged into the next longer window when it closes, and so on up the cascade.
+    def __init__(self, resolutions=RESOLUTIONS, hold=None):
+        self.resolutions = tuple(sorted(resolutions))
+        # seconds a value is assumed to stay valid after its sample, so a channel that only reports
+        # changes still has a value in windows without samples. None disables the carry over.
+        self.hold = hold
+        self._held = {} # channel -> (timestamp, value) of the newest sample
+        self._window_start = None
+        for short, long in zip(self.resolutions, self.resolutions[1:]):
+            if long % short:
+                raise ValueError('Resolution {} is not a multiple of {}'.format(long, short))
+        self._levels = [dict() for _ in self.resolutions]
+        self._next_close = [None] * len(self.resolutions)
+
+    def _accumulator(self, level, channel):
+        acc = self._levels[level].get(channel)
+        if acc is None:
+            acc = self._levels[level][channel] = Accumulator()
+        return acc
+
+    def add(self, channel, value):
+        self._accumulator(0, channel).add(value)
+
+    def update(self, window, window_end=None):
+        # window as returned by SensorBuffer.snapshot(): {channel: (timestamps, values)}. With window_end
+        # every sample is also weighted by the time until the next sample or the end of the window.
+        import numpy as np
+        for channel, (ts, values) in window.items():
+            values = np.asarray(values)
+            if len(values):
+                self._accumulator(0, channel).addArray(values)
+            if window_end is not None:
+                self._addTimeWeights(channel, np.asarray(ts), values, window_end)
+
+    def _addTimeWeights(self, channel, ts, values, window_end):
+        import numpy as np
+        held = self._held.get(channel)
+        first = ts[0] if len(ts) else window_end
+        if held is not None and self.hold is not None and self._window_start is not None:
+            # the value from the previous window is valid until the first sample of this one
+            start = max(self._window_start, held[0])
+            end = min(first, held[0] + self.hold)
+            if end > start:
+                self._accumulator(0, channel).addWeighted(held[1], end - start)
+        if len(ts):
+            durations = np.clip(np.diff(np.append(ts, window_end)), 0, None)
+            if self.hold is not None:
+                durations = np.minimum(durations, self.hold)
+            self._accumulator(0, channel).addWeighted(values, durations)
+            self._held[channel] = (ts[-1], values[-1])
+
+    def close(self, window_end):
+        # close the shortest window at window_end and every longer window whose boundary has been
+        # reached. Returns [(resolution, {channel: Accumulator})] for all closed windows.
+        self._window_start = window_end
+        closed = []
+        carry = None
+        for level, resolution in enumerate(self.resolutions):
+            if self._next_close[level] is None:
+                self._next_close[level] = (math.floor(window_end / resolution) + 1) * resolution
+                if level > 0 and window_end % resolution == 0:
+                    self._next_close[level] = window_end
+            if carry is not None:
+                for channel, acc in carry.items():
+                    self._accumulator(level, channel).merge(acc)
+            if level > 0 and window_end < self._next_close[level]:
+                break
+            carry = self._levels[level]
+            self._levels[level] = dict()
+            self._next_close[level] = (math.floor(window_end / resolution) + 1) * resolution
+            closed.append((resolution, carry))
+        return closed
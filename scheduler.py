@@ -0,0 +1,55 @@
+import math
+import time
+import threading
+
+CLOCK_JUMP = 1.0 # seconds of wall clock change against the monotonic clock that trigger re-alignment
+
+
+class WindowScheduler:
+    # sleeps until the end of each window. Windows are aligned to multiples of period on the wall clock,
+    # the waiting itself is measured on the monotonic clock so it never drifts with the work done per window.
+    def __init__(self, period, stop_event=None):
+        self.period = period
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.missed = 0 # windows skipped because the loop woke up more than a period late
+        self.late = 0 # windows that were processed late but not skipped
+        self._deadline = None # monotonic time of the next window end
+        self._window_end = None # wall clock time of the next window end
+        self._offset = None
+
+    def _align(self):
+        wall, mono = time.time(), time.monotonic()
+        self._offset = wall - mono
+        self._window_end = (math.floor(wall / self.period) + 1) * self.period
+        self._deadline = self._window_end - self._offset
+
+    def wait(self):
+        # returns (window_end, lateness, missed) with window_end as wall clock timestamp, or None when stopped
+        if self._deadline is None:
+            self._align()
+        elif abs(time.time() - time.monotonic() - self._offset) > CLOCK_JUMP:
+            # wall clock was set (e.g. NTP sync after boot), re-align the following windows to it
+            print('Wall clock jumped by [{:.1f}] s, re-aligning windows.'.format(time.time() - time.monotonic() - self._offset))
+            self._align()
+
+        while True:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.stop_event.wait(remaining):
+                return None
+
+        lateness = time.monotonic() - self._deadline
+        missed = int(lateness // self.period)
+        window_end = self._window_end + missed * self.period
+        if missed:
+            self.missed += missed
+        elif lateness > 0.1 * self.period:
+            self.late += 1
+
+        self._window_end = window_end + self.period
+        self._deadline += (missed + 1) * self.period
+        return window_end, lateness - missed * self.period, missed
+
+    def stop(self):
+        self.stop_event.set()
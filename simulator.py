@@ -0,0 +1,424 @@
+import time
+import heapq
+import random
+import threading
+from collections import deque
+
+# Simulated brickd and bricklets. The classes mirror the parts of the tinkerforge API used by the
+# collector (same constants, callback ids and callback signatures with raw integer values), so
+# they can replace the real bindings through sources.loadSource('simulator').
+
+NOISE_LEVEL = 1.0 # scale of the measurement noise, 0 gives noise free signals
+DROPOUT_RATE = 0.0 # probability that a single callback is lost
+SEED = None # set for reproducible runs
+STACK = {'AIQ': 297, 'HUM': 283, 'IRT': 291, 'CO2': 2147} # uid -> device identifier of the bricklets found by enumerate()
+
+
+class Signal:
+    # slowly drifting value with measurement noise, in the raw integer unit of the bricklet
+    def __init__(self, base, noise, drift, low, high, rng):
+        self.value = base
+        self.noise = noise
+        self.drift = drift
+        self.low = low
+        self.high = high
+        self.rng = rng
+
+    def sample(self):
+        self.value = min(self.high, max(self.low, self.value + self.rng.gauss(0, self.drift)))
+        return int(round(min(self.high, max(self.low, self.value + self.rng.gauss(0, self.noise * NOISE_LEVEL)))))
+
+
+class IPConnection:
+    CALLBACK_ENUMERATE = 253
+    CALLBACK_CONNECTED = 0
+    CALLBACK_DISCONNECTED = 1
+
+    ENUMERATION_TYPE_AVAILABLE = 0
+    ENUMERATION_TYPE_CONNECTED = 1
+    ENUMERATION_TYPE_DISCONNECTED = 2
+
+    CONNECT_REASON_REQUEST = 0
+    CONNECT_REASON_AUTO_RECONNECT = 1
+
+    DISCONNECT_REASON_REQUEST = 0
+    DISCONNECT_REASON_ERROR = 1
+    DISCONNECT_REASON_SHUTDOWN = 2
+
+    CONNECTION_STATE_DISCONNECTED = 0
+    CONNECTION_STATE_CONNECTED = 1
+    CONNECTION_STATE_PENDING = 2
+
+    def __init__(self):
+        self.rng = random.Random(SEED)
+        self.host = None
+        self.port = None
+        self.callbacks = {}
+        self.devices = {}
+        self.dropped = 0 # callbacks lost to simulated dropouts
+        self._auto_reconnect = True
+        self._state = IPConnection.CONNECTION_STATE_DISCONNECTED
+        self._queue = [] # (due, seq, device, callback_id, generation)
+        self._calls = deque() # (callback_id, args) of connection callbacks for the dispatcher thread
+        self.stack = dict(STACK)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def connect(self, host, port):
+        self.host, self.port = host, port
+        with self._cond:
+            self._state = IPConnection.CONNECTION_STATE_CONNECTED
+        self._thread = threading.Thread(target=self._dispatch, name='simulated-brickd', daemon=True)
+        self._thread.start()
+        self._callback(IPConnection.CALLBACK_CONNECTED, IPConnection.CONNECT_REASON_REQUEST)
+
+    def disconnect(self):
+        with self._cond:
+            self._state = IPConnection.CONNECTION_STATE_DISCONNECTED
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._callback(IPConnection.CALLBACK_DISCONNECTED, IPConnection.DISCONNECT_REASON_REQUEST)
+
+    def get_connection_state(self):
+        return self._state
+
+    def enumerate(self):
+        self._enumerate(IPConnection.ENUMERATION_TYPE_AVAILABLE)
+
+    def _enumerate(self, enumeration_type, uids=None):
+        for uid in (self.stack if uids is None else uids):
+            self._post(IPConnection.CALLBACK_ENUMERATE, uid, '0', 'a', (1, 0, 0), (2, 0, 0), self.stack[uid], enumeration_type)
+
+    def _post(self, callback_id, *args):
+        with self._cond:
+            self._calls.append((callback_id, args))
+            self._cond.notify()
+
+    def resetDevice(self, uid):
+        # the bricklet restarts and forgets its callback configuration, then announces itself again
+        device = self.devices.get(uid)
+        if device is not None:
+            device.reset()
+        self._enumerate(IPConnection.ENUMERATION_TYPE_CONNECTED, [uid])
+
+    def powerCycle(self, downtime=1.0):
+        # brickd and the whole stack lose power: the connection drops, all bricklets forget their
+        # configuration and after downtime seconds the bindings reconnect on their own
+        with self._cond:
+            self._state = IPConnection.CONNECTION_STATE_PENDING
+            self._queue = []
+            self._calls.clear()
+            self._cond.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        for device in self.devices.values():
+            device.reset()
+        self._callback(IPConnection.CALLBACK_DISCONNECTED, IPConnection.DISCONNECT_REASON_ERROR)
+
+        def reconnect():
+            time.sleep(downtime)
+            with self._cond:
+                if self._state != IPConnection.CONNECTION_STATE_PENDING or not self._auto_reconnect:
+                    return
+                self._state = IPConnection.CONNECTION_STATE_CONNECTED
+            self._thread = threading.Thread(target=self._dispatch, name='simulated-brickd', daemon=True)
+            self._thread.start()
+            self._post(IPConnection.CALLBACK_CONNECTED, IPConnection.CONNECT_REASON_AUTO_RECONNECT)
+            self._enumerate(IPConnection.ENUMERATION_TYPE_CONNECTED)
+        threading.Thread(target=reconnect, daemon=True).start()
+
+    def set_auto_reconnect(self, auto_reconnect):
+        self._auto_reconnect = auto_reconnect
+
+    def register_callback(self, callback_id, function):
+        if function is None:
+            self.callbacks.pop(callback_id, None)
+        else:
+            self.callbacks[callback_id] = function
+
+    def _callback(self, callback_id, *args):
+        function = self.callbacks.get(callback_id)
+        if function is not None:
+            function(*args)
+
+    def _schedule(self, due, device, callback_id, generation):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._queue, (due, self._seq, device, callback_id, generation))
+            self._cond.notify()
+
+    def _dispatch(self):
+        # one thread delivers the callbacks of all devices, like the callback thread of the real bindings
+        while True:
+            with self._cond:
+                call = None
+                while True:
+                    if self._state != IPConnection.CONNECTION_STATE_CONNECTED:
+                        return
+                    if self._calls:
+                        call = self._calls.popleft()
+                        break
+                    if self._queue:
+                        wait = self._queue[0][0] - time.monotonic()
+                        if wait <= 0:
+                            due, _, device, callback_id, generation = heapq.heappop(self._queue)
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+
+            if call is not None:
+                self._callback(call[0], *call[1])
+                continue
+            period = device.emit(callback_id, generation)
+            if period:
+                # catch up after a late wake-up instead of drifting, like the periodic bricklet timers
+                self._schedule(max(due + period, time.monotonic() - period), device, callback_id, generation)
+
+
+class Device:
+    DEVICE_IDENTIFIER = 0
+    DEVICE_DISPLAY_NAME = ''
+
+    THRESHOLD_OPTION_OFF = 'x'
+    THRESHOLD_OPTION_OUTSIDE = 'o'
+    THRESHOLD_OPTION_INSIDE = 'i'
+    THRESHOLD_OPTION_SMALLER = '<'
+    THRESHOLD_OPTION_GREATER = '>'
+
+    def __init__(self, uid, ipcon):
+        self.uid = uid
+        self.ipcon = ipcon
+        self.rng = ipcon.rng
+        self.registered_callbacks = {}
+        self.config = {} # callback_id -> [period, value_has_to_change, option, min, max, generation, last args]
+        ipcon.devices[uid] = self
+
+    def register_callback(self, callback_id, function):
+        if function is None:
+            self.registered_callbacks.pop(callback_id, None)
+        else:
+            self.registered_callbacks[callback_id] = function
+
+    def _configure(self, callback_id, period, value_has_to_change, option='x', low=0, high=0):
+        generation = self.config[callback_id][5] + 1 if callback_id in self.config else 0
+        self.config[callback_id] = [period, value_has_to_change, option, low, high, generation, None]
+        if period > 0:
+            self.ipcon._schedule(time.monotonic() + period / 1000.0, self, callback_id, generation)
+
+    def reset(self):
+        # forget all callback configurations, pending callbacks of the old configuration are discarded
+        for callback_id, config in self.config.items():
+            self.config[callback_id] = [0, False, 'x', 0, 0, config[5] + 1, None]
+
+    def _getConfiguration(self, callback_id):
+        period, value_has_to_change, option, low, high = (self.config.get(callback_id) or [0, False, 'x', 0, 0])[:5]
+        return period, value_has_to_change, option, low, high
+
+    def _values(self, callback_id):
+        raise NotImplementedError
+
+    def emit(self, callback_id, generation):
+        config = self.config.get(callback_id)
+        if config is None or config[5] != generation or config[0] <= 0:
+            return None
+        if self.ipcon.devices.get(self.uid) is not self:
+            # replaced by a new device object for the same uid, which has its own configuration
+            return None
+
+        period, value_has_to_change, option, low, high, _, last = config
+        args = self._values(callback_id)
+        if option != 'x' and not thresholdReached(option, args[0], low, high):
+            return period / 1000.0
+        if value_has_to_change and args == last:
+            return period / 1000.0
+        config[6] = args
+
+        if DROPOUT_RATE and self.rng.random() < DROPOUT_RATE:
+            self.ipcon.dropped += 1
+        else:
+            function = self.registered_callbacks.get(callback_id)
+            if function is not None:
+                function(*args)
+        return period / 1000.0
+
+
+def thresholdReached(option, value, low, high):
+    if option == 'o':
+        return value < low or value > high
+    if option == 'i':
+        return low <= value <= high
+    if option == '<':
+        return value < low
+    if option == '>':
+        return value > low
+    return True
+
+
+class BrickletAirQuality(Device):
+    DEVICE_IDENTIFIER = 297
+    DEVICE_DISPLAY_NAME = 'Air Quality Bricklet'
+
+    CALLBACK_ALL_VALUES = 6
+    CALLBACK_IAQ_INDEX = 10
+    CALLBACK_TEMPERATURE = 14
+    CALLBACK_HUMIDITY = 18
+    CALLBACK_AIR_PRESSURE = 22
+
+    def __init__(self, uid, ipcon):
+        Device.__init__(self, uid, ipcon)
+        self.iaq_index = Signal(50, 2, 0.5, 0, 500, self.rng)
+        self.temperature = Signal(2250, 5, 1, -4000, 8500, self.rng) # °C/100
+        self.humidity = Signal(4500, 20, 3, 0, 10000, self.rng) # %RH/100
+        self.air_pressure = Signal(101325, 5, 2, 30000, 110000, self.rng) # hPa/100
+
+    def _values(self, callback_id):
+        if callback_id == self.CALLBACK_ALL_VALUES:
+            iaq_index = self.iaq_index.sample()
+            accuracy = 3 if iaq_index < 400 else 2
+            return (iaq_index, accuracy, self.temperature.sample(), self.humidity.sample(), self.air_pressure.sample())
+        if callback_id == self.CALLBACK_IAQ_INDEX:
+            return (self.iaq_index.sample(), 3)
+        if callback_id == self.CALLBACK_TEMPERATURE:
+            return (self.temperature.sample(),)
+        if callback_id == self.CALLBACK_HUMIDITY:
+            return (self.humidity.sample(),)
+        return (self.air_pressure.sample(),)
+
+    def get_all_values(self):
+        return self._values(self.CALLBACK_ALL_VALUES)
+
+    def set_all_values_callback_configuration(self, period, value_has_to_change):
+        self._configure(self.CALLBACK_ALL_VALUES, period, value_has_to_change)
+
+    def get_all_values_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_ALL_VALUES)[:2]
+
+    def set_iaq_index_callback_configuration(self, period, value_has_to_change):
+        self._configure(self.CALLBACK_IAQ_INDEX, period, value_has_to_change)
+
+    def set_temperature_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_TEMPERATURE, period, value_has_to_change, option, min, max)
+
+    def set_humidity_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_HUMIDITY, period, value_has_to_change, option, min, max)
+
+    def set_air_pressure_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_AIR_PRESSURE, period, value_has_to_change, option, min, max)
+
+
+class BrickletHumidityV2(Device):
+    DEVICE_IDENTIFIER = 283
+    DEVICE_DISPLAY_NAME = 'Humidity Bricklet 2.0'
+
+    CALLBACK_HUMIDITY = 4
+    CALLBACK_TEMPERATURE = 8
+
+    def __init__(self, uid, ipcon):
+        Device.__init__(self, uid, ipcon)
+        self.humidity = Signal(4400, 10, 3, 0, 10000, self.rng) # %RH/100
+        self.temperature = Signal(2230, 3, 1, -4000, 16500, self.rng) # °C/100
+
+    def _values(self, callback_id):
+        if callback_id == self.CALLBACK_HUMIDITY:
+            return (self.humidity.sample(),)
+        return (self.temperature.sample(),)
+
+    def get_humidity(self):
+        return self.humidity.sample()
+
+    def get_temperature(self):
+        return self.temperature.sample()
+
+    def set_humidity_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_HUMIDITY, period, value_has_to_change, option, min, max)
+
+    def get_humidity_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_HUMIDITY)
+
+    def set_temperature_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_TEMPERATURE, period, value_has_to_change, option, min, max)
+
+    def get_temperature_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_TEMPERATURE)
+
+
+class BrickletTemperatureIRV2(Device):
+    DEVICE_IDENTIFIER = 291
+    DEVICE_DISPLAY_NAME = 'Temperature IR Bricklet 2.0'
+
+    CALLBACK_AMBIENT_TEMPERATURE = 4
+    CALLBACK_OBJECT_TEMPERATURE = 8
+
+    def __init__(self, uid, ipcon):
+        Device.__init__(self, uid, ipcon)
+        self.ambient_temperature = Signal(224, 1, 0.2, -400, 1250, self.rng) # °C/10
+        self.object_temperature = Signal(205, 2, 0.5, -700, 3800, self.rng) # °C/10
+
+    def _values(self, callback_id):
+        if callback_id == self.CALLBACK_AMBIENT_TEMPERATURE:
+            return (self.ambient_temperature.sample(),)
+        return (self.object_temperature.sample(),)
+
+    def get_ambient_temperature(self):
+        return self.ambient_temperature.sample()
+
+    def get_object_temperature(self):
+        return self.object_temperature.sample()
+
+    def set_ambient_temperature_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_AMBIENT_TEMPERATURE, period, value_has_to_change, option, min, max)
+
+    def get_ambient_temperature_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_AMBIENT_TEMPERATURE)
+
+    def set_object_temperature_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_OBJECT_TEMPERATURE, period, value_has_to_change, option, min, max)
+
+    def get_object_temperature_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_OBJECT_TEMPERATURE)
+
+
+class BrickletCO2V2(Device):
+    DEVICE_IDENTIFIER = 2147
+    DEVICE_DISPLAY_NAME = 'CO2 Bricklet 2.0'
+
+    CALLBACK_ALL_VALUES = 8
+    CALLBACK_CO2_CONCENTRATION = 12
+    CALLBACK_TEMPERATURE = 16
+    CALLBACK_HUMIDITY = 20
+
+    def __init__(self, uid, ipcon):
+        Device.__init__(self, uid, ipcon)
+        self.co2_concentration = Signal(650, 8, 2, 0, 40000, self.rng) # ppm
+        self.temperature = Signal(2270, 4, 1, -4000, 12500, self.rng) # °C/100
+        self.humidity = Signal(4300, 15, 3, 0, 10000, self.rng) # %RH/100
+
+    def _values(self, callback_id):
+        if callback_id == self.CALLBACK_ALL_VALUES:
+            return (self.co2_concentration.sample(), self.temperature.sample(), self.humidity.sample())
+        if callback_id == self.CALLBACK_CO2_CONCENTRATION:
+            return (self.co2_concentration.sample(),)
+        if callback_id == self.CALLBACK_TEMPERATURE:
+            return (self.temperature.sample(),)
+        return (self.humidity.sample(),)
+
+    def get_all_values(self):
+        return self._values(self.CALLBACK_ALL_VALUES)
+
+    def set_all_values_callback_configuration(self, period, value_has_to_change):
+        self._configure(self.CALLBACK_ALL_VALUES, period, value_has_to_change)
+
+    def get_all_values_callback_configuration(self):
+        return self._getConfiguration(self.CALLBACK_ALL_VALUES)[:2]
+
+    def set_co2_concentration_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_CO2_CONCENTRATION, period, value_has_to_change, option, min, max)
+
+    def set_temperature_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_TEMPERATURE, period, value_has_to_change, option, min, max)
+
+    def set_humidity_callback_configuration(self, period, value_has_to_change, option, min, max):
+        self._configure(self.CALLBACK_HUMIDITY, period, value_has_to_change, option, min, max)
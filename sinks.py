@@ -0,0 +1,382 @@
+import os
+import csv
+import time
+import json
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+from metrics import REGISTRY
+
+# Output pipeline. Every closed window is handed to a FanOut, which only puts it into the bounded queue
+# of each sink. Every sink drains its own queue from a background thread with its own batching, so a
+# slow or unreachable destination never delays the others or the sampling loop. Sinks created with
+# rollups=True also get the closed longer windows with count, mean, min, max and std per channel.
+
+UPLOAD_FIELDS = ('CO2_PPM', 'AVG_TEMP', 'AVG_RH', 'SP', 'OBJ_TEMP', 'AMB_TEMP', 'IAQIDX', 'IAQ_ACC') # field1 .. field8
+
+ROLLUP_FIELDS = ('COUNT', 'MEAN', 'MIN', 'MAX', 'STD') # per channel of a rollup window
+QUEUE_SIZE = 10000 # windows kept in memory by sinks without a spool
+ROLLUP_QUEUE_SIZE = 1000 # closed rollup windows kept in memory per sink
+MIN_BACKOFF = 5 # seconds to wait after the first failed write
+MAX_BACKOFF = 300
+POLICIES = ('spill', 'drop_oldest', 'drop_newest') # what happens to windows a sink cannot keep up with
+REJECTED = 'rejected' # returned by write() when the destination refused the batch for good, it is dropped
+
+SINK_TIME = REGISTRY.histogram('collector_sink_write_seconds', 'Duration of one batch write per sink', ('group', 'sink'))
+SINK_AGE = REGISTRY.histogram('collector_sink_age_seconds', 'Time from window end until the window was written',
+                              ('group', 'sink'), buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 86400))
+
+
+class WindowQueue:
+    # bounded in-memory queue of (timestamp, values) records. Records stay queued until acknowledged.
+    # When the queue is full the oldest record is dropped, or the new one with drop='newest'.
+    def __init__(self, maxlen=QUEUE_SIZE, drop='oldest'):
+        self._records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self.drop = drop
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def put(self, record):
+        with self._lock:
+            if len(self._records) == self._records.maxlen:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    return
+            self._records.append(record)
+
+    def peek(self, n):
+        with self._lock:
+            return [self._records[i] for i in range(min(n, len(self._records)))]
+
+    def ack(self, n):
+        with self._lock:
+            for _ in range(min(n, len(self._records))):
+                self._records.popleft()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Sink:
+    # one destination with its own queue and writer thread. A batch is written once batch_size windows
+    # are queued or the oldest one waited max_delay seconds, at most once per min_interval seconds.
+    # Subclasses implement write(batch) and return False to retry the batch later with backoff, or
+    # REJECTED to drop a batch the destination will never accept.
+    def __init__(self, name, queue=None, batch_size=1, max_delay=0, min_interval=0, group='', rollups=False):
+        self.name = name
+        self.group = group
+        self.queue = queue if queue is not None else WindowQueue()
+        # (timestamp, resolution, rows) of closed rollup windows, written with writeRollups(batch)
+        self.rollup_queue = WindowQueue(ROLLUP_QUEUE_SIZE) if rollups else None
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.min_interval = min_interval
+        self.timeout = 10 # seconds stop() waits for a write in progress
+        self.backoff = 0
+        self.rollup_backoff = 0 # rollups retry on their own, a failing rollup batch does not hold up the windows
+        self._rollup_retry = 0.0 # monotonic time of the next rollup attempt
+        self.written = 0
+        self.rejected = 0 # windows dropped because the destination refused them
+        self.failed = 0
+        self._opened = False
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._write_time = SINK_TIME.labels(group, name)
+        self._age = SINK_AGE.labels(group, name)
+
+    def push(self, ts, values):
+        self.queue.put((ts, values))
+        self._wakeup.set()
+
+    def pushRollup(self, resolution, ts, rows):
+        if self.rollup_queue is not None:
+            self.rollup_queue.put((ts, resolution, rows))
+            self._wakeup.set()
+
+    def lag(self):
+        # seconds since the end of the oldest window that is not written yet
+        oldest = self.queue.peek(1)
+        return time.time() - oldest[0][0] if oldest else 0.0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def writeRollups(self, batch):
+        raise NotImplementedError
+
+    def start(self):
+        if self.isAlive():
+            if not self._stop.is_set():
+                raise RuntimeError('[{}] [{}] - Sink is already running'.format(self.group, self.name))
+            # stop() returned on its timeout while a write was in progress, a second thread
+            # would write and ack the same windows and close the destination under it
+            self._thread.join(self.timeout)
+            if self._thread.is_alive():
+                raise RuntimeError('[{}] [{}] - Previous sink thread is still writing'.format(self.group, self.name))
+        # every thread gets its own stop event, so a late thread can not be revived by a restart
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name='sink-{}-{}'.format(self.group, self.name), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def isAlive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, stop):
+        try:
+            while not stop.is_set():
+                rollup_wait = self._writeRollups()
+                if len(self.queue) == 0:
+                    self._wakeup.wait(rollup_wait)
+                    self._wakeup.clear()
+                    continue
+                if len(self.queue) < self.batch_size and self.max_delay:
+                    wait = self.queue.peek(1)[0][0] + self.max_delay - time.time()
+                    if wait > 0:
+                        self._wakeup.wait(wait if rollup_wait is None else min(wait, rollup_wait))
+                        self._wakeup.clear()
+                        continue
+
+                batch = self.queue.peek(self.batch_size)
+                result = self._write(batch)
+                if result == REJECTED:
+                    self.queue.ack(len(batch))
+                    self.rejected += len(batch)
+                    self.backoff = 0
+                    stop.wait(self.min_interval)
+                elif result:
+                    self.queue.ack(len(batch))
+                    self.written += len(batch)
+                    self.backoff = 0
+                    now = time.time()
+                    for ts, _ in batch:
+                        self._age.observe(now - ts)
+                    stop.wait(self.min_interval)
+                else:
+                    self.failed += 1
+                    self.backoff = min(MAX_BACKOFF, self.backoff * 2 or MIN_BACKOFF)
+                    stop.wait(self.backoff)
+        finally:
+            if self._opened:
+                self._opened = False
+                self.close()
+
+    def _writeRollups(self):
+        # writes the queued rollups when their backoff allows it, returns the seconds until the
+        # next attempt when rollups are still queued, None otherwise
+        if self.rollup_queue is None or len(self.rollup_queue) == 0:
+            return None
+        wait = self._rollup_retry - time.monotonic()
+        if wait > 0:
+            return wait
+        batch = self.rollup_queue.peek(len(self.rollup_queue))
+        if self._write(batch, self.writeRollups):
+            self.rollup_queue.ack(len(batch))
+            self.rollup_backoff = 0
+            return None
+        self.failed += 1
+        self.rollup_backoff = min(MAX_BACKOFF, self.rollup_backoff * 2 or MIN_BACKOFF)
+        self._rollup_retry = time.monotonic() + self.rollup_backoff
+        return self.rollup_backoff
+
+    def _write(self, batch, write=None):
+        t0 = time.perf_counter()
+        try:
+            if not self._opened:
+                self.open()
+                self._opened = True
+            return (write or self.write)(batch)
+        except Exception as e:
+            print('[{}] [{}] - Could not write [{}] windows: {!r}'.format(self.group, self.name, len(batch), e))
+            if self._opened:
+                # start over with a fresh connection or file on the next attempt
+                self._opened = False
+                try:
+                    self.close()
+                except Exception:
+                    pass
+            return False
+        finally:
+            self._write_time.observe(time.perf_counter() - t0)
+
+
+class FanOut:
+    # hands every window to all sinks, each push only appends to the queue of the sink
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def push(self, ts, data):
+        values = tuple(float(data[field]) for field in UPLOAD_FIELDS)
+        for sink in self.sinks:
+            sink.push(ts, values)
+
+    def pushRollup(self, resolution, ts, rows):
+        # rows of (channel, count, mean, min, max, std), only sinks created with rollups=True keep them
+        for sink in self.sinks:
+            sink.pushRollup(resolution, ts, rows)
+
+
+def isoTime(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+class MqttSink(Sink):
+    # publishes one JSON message per window to <topic>/<group> on an MQTT broker, needs paho-mqtt.
+    # Rollups go to <topic>/<group>/rollup/<resolution>.
+    def __init__(self, name, host='localhost', port=1883, topic='aq2thingspeak', qos=1, timeout=10, rollups=True, **kwargs):
+        Sink.__init__(self, name, rollups=rollups, **kwargs)
+        self.host = host
+        self.port = port
+        self.topic = '{}/{}'.format(topic.rstrip('/'), self.group)
+        self.qos = qos
+        self.timeout = timeout
+        self._client = None
+
+    def open(self):
+        import paho.mqtt.client as mqtt
+        self._mqtt = mqtt
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self._client = mqtt.Client()
+        self._client.connect(self.host, self.port)
+        self._client.loop_start()
+
+    def close(self):
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+
+    def write(self, batch):
+        messages = []
+        for ts, values in batch:
+            payload = dict(time=isoTime(ts))
+            payload.update((field, value) for field, value in zip(UPLOAD_FIELDS, values) if value == value)
+            messages.append(self._client.publish(self.topic, json.dumps(payload), qos=self.qos))
+        return self._confirm(messages)
+
+    def writeRollups(self, batch):
+        messages = []
+        for ts, resolution, rows in batch:
+            payload = dict(time=isoTime(ts), resolution=resolution,
+                           channels={row[0]: {field.lower(): value for field, value in zip(ROLLUP_FIELDS, row[1:]) if value == value}
+                                     for row in rows})
+            messages.append(self._client.publish('{}/rollup/{}'.format(self.topic, resolution), json.dumps(payload), qos=self.qos))
+        return self._confirm(messages)
+
+    def _confirm(self, messages):
+        for message in messages:
+            message.wait_for_publish(self.timeout)
+            if message.rc != self._mqtt.MQTT_ERR_SUCCESS or not message.is_published():
+                print('[{}] [{}] - Broker [{}:{}] did not confirm a window'.format(self.group, self.name, self.host, self.port))
+                return False
+        return True
+
+
+class CsvSink(Sink):
+    # appends windows to one CSV file per day: <path>/<group>-<YYYY-MM-DD>.csv,
+    # rollups to <path>/<group>-rollups-<YYYY-MM-DD>.csv with one row per channel
+    def __init__(self, name, path='.', rollups=True, **kwargs):
+        Sink.__init__(self, name, rollups=rollups, **kwargs)
+        self.path = path
+        self._file = None
+        self._day = None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._day = None
+
+    def _rotate(self, day):
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, '{}-{}.csv'.format(self.group, day))
+        new = not os.path.exists(file_path)
+        self._file = open(file_path, 'a', newline='')
+        self._day = day
+        if new:
+            csv.writer(self._file).writerow(('TIME',) + UPLOAD_FIELDS)
+
+    def write(self, batch):
+        for ts, values in batch:
+            day = datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+            if day != self._day:
+                self._rotate(day)
+            csv.writer(self._file).writerow((datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),)
+                                            + tuple('' if v != v else '{:.6g}'.format(v) for v in values))
+        self._file.flush()
+        return True
+
+    def writeRollups(self, batch):
+        # a few rows per minute at most, the file is opened per window
+        os.makedirs(self.path, exist_ok=True)
+        for ts, resolution, rows in batch:
+            file_path = os.path.join(self.path, '{}-rollups-{}.csv'.format(self.group, datetime.fromtimestamp(ts).strftime('%Y-%m-%d')))
+            new = not os.path.exists(file_path)
+            with open(file_path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(('TIME', 'RESOLUTION', 'CHANNEL') + ROLLUP_FIELDS)
+                time_text = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+                for row in rows:
+                    writer.writerow((time_text, resolution, row[0]) + tuple('' if v != v else '{:.6g}'.format(v) for v in row[1:]))
+        return True
+
+
+class SqliteSink(Sink):
+    # inserts each batch of windows in one transaction into the table windows of an SQLite database,
+    # rollups into the table rollups with one row per channel
+    def __init__(self, name, path='aq2thingspeak.sqlite', batch_size=50, max_delay=300, rollups=True, **kwargs):
+        Sink.__init__(self, name, batch_size=batch_size, max_delay=max_delay, rollups=rollups, **kwargs)
+        self.path = path
+        self._db = None
+
+    def open(self):
+        # the connection belongs to the writer thread
+        import sqlite3
+        self._db = sqlite3.connect(self.path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS windows (time REAL NOT NULL, grp TEXT NOT NULL, {}, '
+                         'PRIMARY KEY (grp, time))'.format(', '.join('{} REAL'.format(f) for f in UPLOAD_FIELDS)))
+        self._db.execute('CREATE TABLE IF NOT EXISTS rollups (time REAL NOT NULL, grp TEXT NOT NULL, resolution INTEGER NOT NULL, '
+                         'channel TEXT NOT NULL, {}, PRIMARY KEY (grp, resolution, channel, time))'.format(
+                             ', '.join('{} REAL'.format(f) for f in ROLLUP_FIELDS)))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def write(self, batch):
+        rows = [(ts, self.group) + tuple(None if v != v else v for v in values) for ts, values in batch]
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO windows VALUES ({})'.format(', '.join('?' * (2 + len(UPLOAD_FIELDS)))), rows)
+        return True
+
+    def writeRollups(self, batch):
+        rows = [(ts, self.group, resolution, row[0]) + tuple(None if v != v else v for v in row[1:])
+                for ts, resolution, channels in batch for row in channels]
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO rollups VALUES ({})'.format(', '.join('?' * (4 + len(ROLLUP_FIELDS)))), rows)
+        return True
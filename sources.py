@@ -0,0 +1,26 @@
+import importlib
+from types import SimpleNamespace
+
+SOURCES = ('tinkerforge', 'simulator')
+# bricklet type -> (module of the tinkerforge bindings, class name)
+BRICKLET_CLASSES = dict(air_quality=('bricklet_air_quality', 'BrickletAirQuality'),
+                        humidity=('bricklet_humidity_v2', 'BrickletHumidityV2'),
+                        ir_temperature=('bricklet_temperature_ir_v2', 'BrickletTemperatureIRV2'),
+                        co2=('bricklet_co2_v2', 'BrickletCO2V2'))
+
+
+def loadSource(name, bricklets=None):
+    # IPConnection and bricklet classes of a sensor source, either the real tinkerforge bindings
+    # talking to brickd or the simulator with the same API. Only the modules of the given bricklet
+    # types are imported, classes of the other types are None.
+    if name == 'tinkerforge':
+        load = lambda module, attribute: getattr(importlib.import_module('tinkerforge.' + module), attribute)
+    elif name == 'simulator':
+        load = lambda module, attribute: getattr(importlib.import_module('simulator'), attribute)
+    else:
+        raise ValueError('Unknown sensor source [{}], use one of: {}'.format(name, ', '.join(SOURCES)))
+
+    source = SimpleNamespace(name=name, IPConnection=load('ip_connection', 'IPConnection'))
+    for bricklet, (module, attribute) in BRICKLET_CLASSES.items():
+        setattr(source, attribute, load(module, attribute) if bricklets is None or bricklet in bricklets else None)
+    return source
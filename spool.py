@@ -0,0 +1,133 @@
+import os
+import mmap
+import time
+import struct
+import threading
+
+SPOOL_MAGIC = b'AQS1'
+HEADER = struct.Struct('<4sIQ') # magic, fields per record, index of the first unsent record
+MAX_RECORDS = 100000 # unsent windows kept on disk, about 3 weeks of 20 s windows
+FSYNC_EVERY = 16 # records written before the spool is synced to disk
+FSYNC_INTERVAL = 60 # seconds after which pending records are synced regardless of count
+COMPACT_MIN = 1024 # sent records at the start of the file before compaction is considered
+
+
+class Spool:
+    # durable append-only file of fixed-size (timestamp, values) records. It has the same put/peek/ack
+    # interface as sinks.WindowQueue, so unsent windows survive crashes and restarts.
+    def __init__(self, path, fields=8, max_records=MAX_RECORDS, fsync_every=FSYNC_EVERY, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.fields = fields
+        self.record = struct.Struct('<d{}d'.format(fields))
+        self.max_records = max_records
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._map = None
+        self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            os.pwrite(self._fd, HEADER.pack(SPOOL_MAGIC, self.fields, 0), 0)
+            os.ftruncate(self._fd, HEADER.size)
+            os.fsync(self._fd)
+            size = HEADER.size
+
+        magic, fields, head = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+        if magic != SPOOL_MAGIC or fields != self.fields:
+            os.close(self._fd)
+            raise ValueError('{} is not a spool with {} fields'.format(self.path, self.fields))
+
+        # drop a record that was only partially written before a crash
+        self._tail = (size - HEADER.size) // self.record.size
+        if HEADER.size + self._tail * self.record.size != size:
+            os.ftruncate(self._fd, HEADER.size + self._tail * self.record.size)
+        self._head = min(head, self._tail)
+        self._remap()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, HEADER.size + self._tail * self.record.size, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def put(self, record):
+        ts, values = record
+        with self._lock:
+            os.pwrite(self._fd, self.record.pack(ts, *values), HEADER.size + self._tail * self.record.size)
+            self._tail += 1
+            self._pending += 1
+            if self._tail - self._head > self.max_records:
+                # keep the newest windows during long offline periods
+                excess = self._tail - self._head - self.max_records
+                self._head += excess
+                self.dropped += excess
+                self._writeHeader()
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            self._maybeCompact()
+
+    def peek(self, n):
+        with self._lock:
+            n = min(n, self._tail - self._head)
+            if HEADER.size + (self._head + n) * self.record.size > len(self._map):
+                self._remap()
+            records = []
+            for i in range(self._head, self._head + n):
+                unpacked = self.record.unpack_from(self._map, HEADER.size + i * self.record.size)
+                records.append((unpacked[0], unpacked[1:]))
+            return records
+
+    def ack(self, n):
+        with self._lock:
+            self._head = min(self._tail, self._head + n)
+            self._writeHeader()
+            self._sync()
+            self._maybeCompact()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._map.close()
+            os.close(self._fd)
+
+    def _writeHeader(self):
+        os.pwrite(self._fd, HEADER.pack(SPOOL_MAGIC, self.fields, self._head), 0)
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def _maybeCompact(self):
+        if self._head >= COMPACT_MIN and self._head * 2 >= self._tail:
+            self._compact()
+
+    def _compact(self):
+        # rewrite the unsent records into a new file and atomically replace the spool with it
+        start = HEADER.size + self._head * self.record.size
+        remaining = os.pread(self._fd, (self._tail - self._head) * self.record.size, start)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, HEADER.pack(SPOOL_MAGIC, self.fields, 0) + remaining)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+
+        self._map.close()
+        self._map = None
+        os.close(self._fd)
+        self._open()
@@ -0,0 +1,169 @@
+import time
+import threading
+import traceback
+
+CHECK_INTERVAL = 1.0 # seconds between two health checks of all components
+MAX_RETRY_DELAY = 30 # seconds between restart attempts of a component that keeps failing
+
+
+class Component:
+    # a restartable part of the collector. check(component) returns None while healthy and a
+    # short cause otherwise. Components listed in requires are started first and their restart
+    # also restarts this component.
+    def __init__(self, name, start, stop=None, check=None, requires=()):
+        self.name = name
+        self._start = start
+        self._stop = stop
+        self._check = check
+        self.requires = tuple(requires)
+        self.started = None # wall clock time of the last successful start
+        self.running = False
+        self.restarts = 0
+        self.failed_since = None # monotonic time when the current outage was detected
+        self.retry_at = 0
+        self.retry_delay = 0
+
+    def start(self):
+        self._start()
+        self.started = time.time()
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        if self._stop is not None:
+            self._stop()
+
+    def check(self):
+        if not self.running:
+            return 'not running'
+        if self._check is None:
+            return None
+        return self._check(self)
+
+
+class Supervisor:
+    # keeps all components of the collector running in this process. A failed component is torn down
+    # and rebuilt on its own, imports, buffers and queued data of everything else are kept.
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.components = {}
+        self.history = [] # (wall time, component, cause, time to recovery in s)
+        self._lock = threading.RLock()
+        self._faults = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, component):
+        self.components[component.name] = component
+        return component
+
+    def _dependents(self, name):
+        # components that (transitively) require name, in start order
+        dependents = []
+        for component in self.components.values():
+            if any(req == name or req in [d.name for d in dependents] for req in component.requires):
+                dependents.append(component)
+        return dependents
+
+    def startAll(self):
+        with self._lock:
+            for component in self.components.values():
+                self._tryStart(component, 'initial start')
+
+    def stopAll(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            for component in reversed(list(self.components.values())):
+                self._tryStop(component)
+
+    def fault(self, name, cause):
+        # report a failure noticed outside the health checks, e.g. in a bricklet callback or its setup
+        # after an enumeration. Reports for a component that is waiting for its next attempt are merged.
+        if name in self.components and name not in self._faults:
+            self._faults[name] = cause
+            self._wakeup.set()
+
+    def check(self):
+        with self._lock:
+            for component in self.components.values():
+                cause = self._faults.get(component.name)
+                if cause is None:
+                    try:
+                        cause = component.check()
+                    except Exception as e:
+                        cause = 'health check raised {!r}'.format(e)
+                if cause is not None and self.restart(component, cause):
+                    self._faults.pop(component.name, None)
+
+    def restart(self, component, cause):
+        now = time.monotonic()
+        if component.failed_since is None:
+            component.failed_since = now
+            print('[Supervisor] - {} failed: {}'.format(component.name, cause))
+        if now < component.retry_at:
+            return False
+
+        t0 = time.monotonic()
+        dependents = self._dependents(component.name)
+        for dependent in reversed(dependents):
+            self._tryStop(dependent)
+        self._tryStop(component)
+
+        last_start = component.started
+        if not self._tryStart(component, cause):
+            component.retry_delay = min(MAX_RETRY_DELAY, component.retry_delay * 2 or self.check_interval)
+            component.retry_at = time.monotonic() + component.retry_delay
+            return False
+        for dependent in dependents:
+            self._tryStart(dependent, 'restart of {}'.format(component.name))
+
+        done = time.monotonic()
+        component.restarts += 1
+        if last_start is not None and time.time() - last_start < MAX_RETRY_DELAY:
+            # failing again right after a restart, e.g. a callback that keeps raising, restart less often
+            component.retry_delay = min(MAX_RETRY_DELAY, component.retry_delay * 2 or self.check_interval)
+            component.retry_at = time.monotonic() + component.retry_delay
+        else:
+            component.retry_delay = 0
+        recovery = done - component.failed_since
+        component.failed_since = None
+        self.history.append((time.time(), component.name, cause, recovery))
+        print('[Supervisor] - Restarted {} in [{:.1f}] ms, [{:.1f}] ms after the failure was detected. Cause: {}'.format(
+                component.name, (done - t0) * 1000, recovery * 1000, cause))
+        return True
+
+    def _tryStart(self, component, cause):
+        try:
+            component.start()
+            return True
+        except Exception:
+            print('[Supervisor] - Could not start {} ({}):\n{}'.format(component.name, cause, traceback.format_exc()))
+            component.running = False
+            return False
+
+    def _tryStop(self, component):
+        try:
+            component.stop()
+        except Exception as e:
+            print('[Supervisor] - Error while stopping {}: {!r}'.format(component.name, e))
+
+    def watch(self):
+        # run the health checks from a background thread until stopAll()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='supervisor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            if not self._stop.is_set():
+                self.check()
+
+    @property
+    def restartCount(self):
+        return sum(component.restarts for component in self.components.values())
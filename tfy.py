@@ -1,13 +1,22 @@
-import sys, os
+
+import sys
 import time
-from subprocess import Popen
+import traceback
 from datetime import datetime
 
-file_dir = os.path.dirname(os.path.realpath(__file__))
-filename = os.path.join(file_dir, 'aq2thingspeak_v2.py')
+# imported once, restarts below reuse the loaded modules, sample buffers and the upload spool
+import aq2thingspeak_v2 as collector
+
+RESTART_DELAY = 1 # seconds before the collector is started again after a crash
 
 while True:
     timestamp = datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
-    print("\nStarting [ " + timestamp + " ]: " + filename)
-    p = Popen("python3.7 " + filename + " > logs/" + timestamp + ".log", shell=True)
-    p.wait()
+    print("\nStarting [ " + timestamp + " ]: " + collector.__file__)
+    started = time.monotonic()
+    try:
+        collector.main(sys.argv[1] if len(sys.argv) > 1 else None)
+    except KeyboardInterrupt:
+        break
+    except Exception:
+        print('Collector crashed after [{:.0f}] s:\n{}'.format(time.monotonic() - started, traceback.format_exc()))
+    time.sleep(RESTART_DELAY)
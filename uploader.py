@@ -0,0 +1,70 @@
+import requests as req
+
+from sinks import Sink, isoTime, REJECTED
+
+THINGSPEAK_URL = 'https://api.thingspeak.com'
+BATCH_SIZE = 960 # max updates per bulk request accepted by ThingSpeak
+MIN_INTERVAL = 15 # seconds between two bulk requests (ThingSpeak rate limit)
+TIMEOUT = 10 # seconds for connect and read of one request
+
+
+class ThingSpeakUploader(Sink):
+    # posts queued windows using ThingSpeak's bulk update API, or one window per request with the
+    # update API when no channel id is configured, which only needs the write key
+    def __init__(self, channel_id, write_key, queue=None, base_url=THINGSPEAK_URL, batch_size=BATCH_SIZE,
+                 min_interval=MIN_INTERVAL, timeout=TIMEOUT, name='thingspeak', group='', max_delay=0):
+        self.bulk = channel_id not in (None, '')
+        Sink.__init__(self, name, queue, batch_size if self.bulk else 1, max_delay, min_interval, group)
+        if self.bulk:
+            self.url = '{}/channels/{}/bulk_update.json'.format(base_url.rstrip('/'), channel_id)
+        else:
+            self.url = '{}/update.json'.format(base_url.rstrip('/'))
+        self.write_key = write_key
+        self.timeout = timeout
+        self.channel_id = str(channel_id)
+        self._session = None
+
+    def open(self):
+        self._session = req.Session()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def write(self, batch):
+        if self.bulk:
+            payload = {'write_api_key': self.write_key, 'updates': [bulkUpdate(ts, values) for ts, values in batch]}
+        else:
+            payload = dict(bulkUpdate(*batch[0]), api_key=self.write_key)
+        try:
+            r = self._session.post(self.url, json=payload, timeout=self.timeout)
+        except req.exceptions.RequestException as e:
+            print('Could not reach [{}]: {}'.format(self.url, e))
+            return False
+        if not self.bulk and r.status_code < 400 and r.text.strip() == '0':
+            # the update API answers 0 instead of an entry id when it did not store the window, e.g. rate limited
+            print('Could not write at [{}]: window not accepted'.format(self.url))
+            return False
+
+        if r.status_code < 400:
+            return True
+        if r.status_code in (401, 403, 404):
+            # wrong channel id, write key or url, keep the windows until the config is fixed
+            print('[{}] [{}] - [{}] refused the write key or channel [{}]: {}, check channel_id and write_key'.format(
+                self.group, self.name, self.url, self.channel_id, r.status_code))
+            return False
+        if r.status_code not in (408, 429) and r.status_code < 500:
+            # the request itself is rejected, retrying would block the queue forever
+            print('Dropping [{}] windows rejected by [{}]: {}'.format(len(batch), self.url, r.status_code))
+            return REJECTED
+        print('Could not write at [{}]: {}'.format(self.url, r.status_code))
+        return False
+
+
+def bulkUpdate(ts, values):
+    update = {'created_at': isoTime(ts)}
+    for i, value in enumerate(values):
+        if value == value: # skip NaN, i.e. fields without data in the window
+            update['field{}'.format(i + 1)] = value
+    return update